@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline benchmarks for the counting pipeline.
+
+Generates a synthetic network at a given scale (see
+`generate_test_data.generateNetwork`) and times every stage of a
+recount: vote ingestion, ID resolution, building the indexes, counting,
+tallying and loading the deals snapshot. With `--workers`, weighing the
+votes is also timed on that many processes and the speedup is reported;
+it is only meaningful on a machine with at least that many CPUs. Every stage is run `--repeat` times
+and its median is reported. Results are written as JSON and can be compared
+against a stored baseline made with the same parameters, e.g.
+
+    python benchmark.py --scale small --output bench.json
+    python benchmark.py --scale small --baseline bench.json
+
+@author: JP
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from counting import (available_cpus, count_all, countVote, weigh_votes,
+                      weigh_votes_parallel)
+from generate_test_data import generateNetwork
+from groups import groups
+from indexes import AddressIndex, DealAggregates, MinerGraph
+from snapshots import SnapshotStore
+from votes import ingest
+
+# number of miners, deals and votes of each preset
+SCALES = {'small': {'miners': 10000, 'deals': 1000000, 'votes': 1000},
+          'medium': {'miners': 100000, 'deals': 1000000, 'votes': 50000},
+          'large': {'miners': 1000000, 'deals': 10000000, 'votes': 500000}}
+
+# votes counted one at a time with countVote, to time the per-vote path
+LOOP_VOTES = 1000
+
+
+class Stopwatch:
+    '''
+    collects the wall times of named stages, one per repeat
+    '''
+
+    def __init__(self):
+        self.samples = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        t0 = time.perf_counter()
+        yield
+        self.samples.setdefault(name, []).append(time.perf_counter() - t0)
+
+    def medians(self):
+        return {name: float(np.median(times)) for name, times in self.samples.items()}
+
+
+def run(miners: int, deals: int, votes: int, seed: int = 0, workers: int = 1,
+        repeat: int = 5):
+    '''
+    times every stage of a recount on a synthetic network, `repeat` times
+
+    Returns
+    -------
+    result : dict
+        parameters, environment, median seconds per stage ('stages') and
+        every sample ('samples').
+
+    '''
+    network = generateNetwork(n_miners=miners, n_deals=deals, n_votes=votes,
+                              seed=seed)
+    watch = Stopwatch()
+    for _ in range(repeat):
+        _time_stages(network, watch, workers)
+    stages = watch.medians()
+    stages['countVote_per_vote'] = stages['countVote_loop'] / max(min(votes, LOOP_VOTES), 1)
+    if 'weigh_votes_parallel' in stages:
+        speedup = stages['weigh_votes'] / stages['weigh_votes_parallel']
+    else:
+        speedup = None
+
+    return {'parameters': {'miners': miners, 'deals': deals, 'votes': votes,
+                           'seed': seed, 'workers': workers},
+            'environment': {'python': platform.python_version(),
+                            'numpy': np.__version__,
+                            'pandas': pd.__version__,
+                            'machine': platform.machine(),
+                            'cpus': available_cpus()},
+            'repeat': repeat,
+            'parallel_speedup': speedup,
+            'stages': stages,
+            'samples': watch.samples}
+
+
+def _time_stages(network: dict, watch: Stopwatch, workers: int):
+    with watch.stage('ingestion'):
+        list_of_votes = ingest(network['votes'])
+
+    with watch.stage('address_index'):
+        address_index = AddressIndex(network['addresses'])
+    with watch.stage('resolution'):
+        address_index.resolve_many(list_of_votes['signer'])
+    with watch.stage('deal_aggregates'):
+        deal_aggregates = DealAggregates(network['deals'])
+    with watch.stage('miner_graph'):
+        miner_graph = MinerGraph(network['miners'], network['powers'])
+
+    datasets = dict(network, address_index=address_index,
+                    deal_aggregates=deal_aggregates, miner_graph=miner_graph)
+    with watch.stage('weigh_votes'):
+        weigh_votes(list_of_votes, datasets)
+    if workers != 1:
+        with watch.stage('weigh_votes_parallel'):
+            weigh_votes_parallel(list_of_votes, datasets, workers=workers)
+    with watch.stage('count_all'):
+        groups_of_voters, _ = count_all(list_of_votes, datasets)
+    if workers != 1:
+        with watch.stage('count_all_parallel'):
+            count_all(list_of_votes, datasets, workers=workers)
+
+    sample = list_of_votes.iloc[:LOOP_VOTES]
+    loop_groups = {'deal': groups(1), 'capacity': groups(2), 'client': groups(3),
+                   'token': groups(4), 'core': groups(5)}
+    signatures = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        with watch.stage('countVote_loop'):
+            for ii in range(len(sample)):
+                countVote(sample.iloc[ii], loop_groups, datasets, signatures)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        with watch.stage('groups_count'):
+            for group in groups_of_voters.values():
+                group.count()
+
+    with tempfile.TemporaryDirectory() as root:
+        store = SnapshotStore(root)
+        store.write('market_deals', 0, network['deals'])
+        with watch.stage('snapshot_load'):
+            store.read('market_deals', 0,
+                       columns=['client_id', 'provider_id', 'unpadded_piece_size'])
+
+
+def compare(result: dict, baseline: dict, max_regression: float = 1.2,
+            min_seconds: float = 0.01):
+    '''
+    compares the median stage timings of `result` with `baseline`
+
+    Raises
+    ------
+    ValueError
+        if the two runs were not made with the same parameters.
+
+    Returns
+    -------
+    ratios : dict
+        stage -> seconds / baseline seconds.
+    regressions : list
+        stages that are more than `max_regression` times and at least
+        `min_seconds` slower, so that the jitter of millisecond-scale
+        stages is not flagged.
+
+    '''
+    if result['parameters'] != baseline.get('parameters'):
+        raise ValueError('baseline parameters {} differ from {}'.format(
+            baseline.get('parameters'), result['parameters']))
+    ratios = {}
+    regressions = []
+    for stage, seconds in result['stages'].items():
+        before = baseline['stages'].get(stage)
+        if before:
+            ratios[stage] = seconds / before
+            if ratios[stage] > max_regression and seconds - before >= min_seconds:
+                regressions.append(stage)
+    return ratios, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--miners', type=int)
+    parser.add_argument('--deals', type=int)
+    parser.add_argument('--votes', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='also time count_all on this many processes')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs per stage; the median is reported')
+    parser.add_argument('--max-regression', type=float, default=1.2)
+    parser.add_argument('--min-seconds', type=float, default=0.01,
+                        help='slowdowns smaller than this are not flagged')
+    args = parser.parse_args(argv)
+
+    parameters = dict(SCALES[args.scale])
+    for key in parameters:
+        if getattr(args, key) is not None:
+            parameters[key] = getattr(args, key)
+    result = run(seed=args.seed, workers=args.workers, repeat=args.repeat,
+                 **parameters)
+    result['scale'] = args.scale
+
+    for stage, seconds in result['stages'].items():
+        print('{:>20}: {:10.4f} s'.format(stage, seconds))
+    if result['parallel_speedup'] is not None:
+        print('{:>20}: {:10.2f}x on {} workers, {} CPUs'.format(
+            'parallel_speedup', result['parallel_speedup'], args.workers,
+            result['environment']['cpus']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        try:
+            ratios, regressions = compare(result, baseline, args.max_regression,
+                                          args.min_seconds)
+        except ValueError as error:
+            print('not comparing: {}'.format(error))
+            return 2
+        print('')
+        for stage, ratio in ratios.items():
+            print('{:>20}: {:6.2f}x baseline'.format(stage, ratio))
+        if regressions:
+            print('regressions: ' + ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
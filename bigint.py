@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Exact sums of large non-negative integers, such as balances in attoFIL
+(which overflow an int64) or deal bytes (which get close to it), and exact
+shares of a tally.
+
+Values that fit in an int64 are split into 32-bit limbs stored in uint64
+arrays, the limbs are summed with numpy (a column of up to 2**32 limbs cannot
+overflow a uint64), and the carries are then propagated from the low limb to
+the high one. Values that do not fit are python ints already, and adding
+them up directly is faster than any conversion to limbs, so they are summed
+as they are. The tallies of `groups.groups` are plain sums of python ints for
+the same reason.
+
+@author: JP
+"""
+
+from fractions import Fraction
+import numpy as np
+
+LIMB_BITS = 32
+LIMB_MASK = (1 << LIMB_BITS) - 1
+
+
+def to_limbs(values):
+    '''
+    splits non-negative int64 values into 32-bit limbs, without arithmetic on
+    python objects: every value is reinterpreted as a pair of uint32
+
+    Parameters
+    ----------
+    values : array-like
+        integers that fit in an int64.
+
+    Returns
+    -------
+    limbs : numpy.ndarray
+        uint64 array of shape (len(values), 2), lowest limb first.
+
+    '''
+    array = np.asarray(values, dtype=np.int64)
+    if (array < 0).any():
+        raise ValueError('only non-negative integers can be split into limbs')
+    limbs = array.astype('<i8').view('<u4').reshape(len(array), 2)
+    return limbs.astype(np.uint64)
+
+
+def from_limbs(sums):
+    '''
+    propagates the carries of summed limbs and returns the python ints they
+    represent
+
+    Parameters
+    ----------
+    sums : numpy.ndarray
+        uint64 array of shape (n, n_limbs), lowest limb first, where every
+        entry is a sum of 32-bit limbs.
+
+    Returns
+    -------
+    totals : list
+        n python ints.
+
+    '''
+    sums = sums.copy()
+    n_limbs = sums.shape[1]
+    carries = np.zeros(len(sums), dtype=np.uint64)
+    for k in range(n_limbs):
+        sums[:, k] += carries
+        carries = sums[:, k] >> np.uint64(LIMB_BITS)
+        sums[:, k] &= np.uint64(LIMB_MASK)
+    # the limbs now fit in 32 bits, so every row is read as one
+    # little-endian number, with its last carry on top
+    rows = np.ascontiguousarray(sums.astype('<u4'))
+    return [int.from_bytes(row.tobytes(), 'little') + (int(carry) << (LIMB_BITS * n_limbs))
+            for row, carry in zip(rows, carries)]
+
+
+def _int64(values):
+    '''
+    `values` as an int64 array, or None if they do not all fit
+    '''
+    try:
+        return np.asarray(values, dtype=np.int64)
+    except (OverflowError, TypeError, ValueError):
+        return None
+
+
+def exact_sum(values):
+    '''
+    exact sum of non-negative integers, as a python int
+    '''
+    if len(values) == 0:
+        return 0
+    array = _int64(values)
+    if array is None:
+        # values that do not fit in an int64 are python ints already, and
+        # summing them directly is faster than splitting them into limbs
+        return sum(int(v) for v in values)
+    limbs = to_limbs(array)
+    return from_limbs(limbs.sum(axis=0, keepdims=True))[0]
+
+
+def shares(tally: dict):
+    '''
+    exact share of every option in `tally`, as fractions.Fraction
+    '''
+    total = sum(tally.values())
+    if total == 0:
+        return {option: Fraction(0) for option in tally}
+    return {option: Fraction(int(amount), total) for option, amount in tally.items()}
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Incremental recounts. A checkpoint stores the groups of voters together with
+the id, position and `updatedAt` of every vote already counted, so that the
+next run only has to apply the votes that are new or that changed since.
+
+Votes are applied in the same order as in a full recount: new votes go after
+all the ones already counted, and a changed vote (a revote) keeps the
+position of the vote it replaces. This assumes the votes API keeps a single
+vote per signer and updates it in place on a revote.
+
+@author: JP
+"""
+
+import os
+import pickle
+import pandas as pd
+from groups import groups
+from counting import weigh_votes
+
+
+def checkpoint_path(pollId: int, height: int, root: str = 'datasets'):
+    '''
+    default path of the checkpoint of poll `pollId` at `height`
+    '''
+    return os.path.join(root, 'checkpoint_{}_{}.pkl'.format(pollId, height))
+
+
+class Checkpoint:
+    '''
+    state of an incremental count.
+
+    * `height` snapshot height the votes were counted at
+    * `pollId` poll the votes belong to
+    * `groups_of_voters` the 'deal', 'capacity', 'client', 'token' and 'core' groups
+    * `updatedAt` vote id -> updatedAt of the version that was counted
+    * `position` vote id -> position of the vote in the count
+    * `signer` vote id -> signer of the vote
+    * `lastOverride` worker address -> position of the last owner vote
+      that overrode it
+    '''
+
+    def __init__(self, height: int, pollId: int = None):
+        self.height = height
+        self.pollId = pollId
+        self.groups_of_voters = {'deal': groups(1),
+                                 'capacity': groups(2),
+                                 'client': groups(3),
+                                 'token': groups(4),
+                                 'core': groups(5)}
+        self.updatedAt = {}
+        self.position = {}
+        self.signer = {}
+        self.lastOverride = {}
+
+    @classmethod
+    def load(cls, path: str, height: int, pollId: int = None):
+        '''
+        loads the checkpoint stored in `path`. Returns an empty checkpoint if
+        there is none, or if it was taken at a different height or for a
+        different poll
+        '''
+        try:
+            with open(path, 'rb') as f:
+                checkpoint = pickle.load(f)
+        except FileNotFoundError:
+            print('no checkpoint found, counting from scratch...')
+            return cls(height, pollId)
+        if checkpoint.height != height:
+            print('checkpoint is for height {}, counting from scratch...'.format(
+                checkpoint.height))
+            return cls(height, pollId)
+        # checkpoints saved before the poll was recorded have no pollId
+        if getattr(checkpoint, 'pollId', None) != pollId:
+            print('checkpoint is for poll {}, counting from scratch...'.format(
+                getattr(checkpoint, 'pollId', None)))
+            return cls(height, pollId)
+        return checkpoint
+
+    def save(self, path: str):
+        '''
+        writes the checkpoint to `path`. The file is replaced atomically, so an
+        interrupted run never leaves a half-written checkpoint behind
+        '''
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def pending(self, list_of_votes: pd.core.frame.DataFrame):
+        '''
+        returns the votes in `list_of_votes` that are new or changed since
+        the last update
+        '''
+        seen = self.updatedAt
+        is_pending = [Id not in seen or _is_newer(updatedAt, seen[Id])
+                      for Id, updatedAt in zip(list_of_votes['id'],
+                                               _updated(list_of_votes))]
+        return list_of_votes[pd.Series(is_pending, dtype=bool).to_numpy()]
+
+    def update(self, list_of_votes: pd.core.frame.DataFrame, datasets: dict):
+        '''
+        applies the new and changed votes in `list_of_votes`
+
+        Parameters
+        ----------
+        list_of_votes : pandas.DataFrame
+            all the votes of the poll, as returned by `votes.Votes`.
+        datasets : dict
+            as returned by `preprocess.dataPreprocess`.
+
+        Returns
+        -------
+        n_applied : int
+            number of votes that were applied
+
+        '''
+        pending = self.pending(list_of_votes)
+        if len(pending) == 0:
+            return 0
+        weights = weigh_votes(pending, datasets)
+        self._bind(datasets)
+        next_position = len(self.position)
+        for Id, updatedAt, (_, weight) in zip(pending['id'], _updated(pending),
+                                              weights.iterrows()):
+            is_new = Id not in self.position
+            if is_new:
+                self.position[Id] = next_position
+                next_position += 1
+            else:
+                self._remove(self.signer[Id])
+            self.updatedAt[Id] = updatedAt
+            self.signer[Id] = weight['signer']
+            self._apply(weight, self.position[Id], is_new,
+                        datasets.get('multisig_index'))
+        return len(pending)
+
+    def _bind(self, datasets: dict):
+        '''
+        points the multisig approvals at the index in `datasets`, which is
+        not saved with the checkpoint
+        '''
+        approvals = getattr(self.groups_of_voters['token'], 'multisigApprovals', None)
+        if approvals is None:
+            return
+        multisig_index = datasets.get('multisig_index')
+        if multisig_index is None:
+            raise ValueError("the checkpoint counted multisig votes, "
+                             "datasets['multisig_index'] is needed to update it")
+        approvals.index = multisig_index
+
+    def _remove(self, signer: str):
+        for group in self.groups_of_voters.values():
+            group.removeVote(signer)
+
+    def _apply(self, weight: pd.core.series.Series, position: int, is_new: bool,
+               multisig_index=None):
+        '''
+        applies the weights of one vote at `position`, following the same
+        rules as `counting.countVote`
+        '''
+        groups_of_voters = self.groups_of_voters
+        signature = {'signer': weight['signer'],
+                     'short': weight['short'],
+                     'optionName': weight['optionName'],
+                     'power': weight['power'],
+                     'balance': weight['balance']}
+        if weight['is_core']:
+            groups_of_voters['core'].validateAndAddVote(signature)
+        groups_of_voters['token'].validateAndAddVote(signature)
+        if multisig_index is not None:
+            groups_of_voters['token'].approveMultisigs(multisig_index, signature,
+                                                       position)
+        if weight['client'] > 0:
+            groups_of_voters['client'].validateAndAddVote(
+                signature, amount=weight['client'])
+
+        # an owner's vote overrides its worker's. A revote keeps the position
+        # of the original vote, where the override was already applied
+        other = weight['other_long']
+        if is_new and weight['role'] == 'owner' and pd.notna(other) \
+                and other != signature['signer']:
+            self.lastOverride[other] = position
+            for gr in ['capacity', 'deal']:
+                if groups_of_voters[gr].has_voted(other):
+                    print('overwritting ' + other)
+                    groups_of_voters[gr].removeVote(other)
+        if self.lastOverride.get(signature['signer'], -1) > position:
+            return
+        groups_of_voters['capacity'].validateAndAddVote(
+            signature, amount=weight['capacity'],
+            other_info={'miner_ids': list(weight['miner_ids'])})
+        groups_of_voters['deal'].validateAndAddVote(
+            signature, amount=weight['deal'])
+
+
+def _updated(list_of_votes: pd.core.frame.DataFrame):
+    if 'updatedAt' in list_of_votes:
+        return list_of_votes['updatedAt'].tolist()
+    return [None] * len(list_of_votes)
+
+
+def _is_newer(updatedAt, counted):
+    if updatedAt is None or pd.isna(updatedAt):
+        return False
+    return counted is None or pd.isna(counted) or updatedAt > counted
@@ -7,47 +7,74 @@ Created on Sun Sep 18 23:27:17 2022
 """
 
 import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
 import datautils as utils
+from groups import groups,Vote
+import tracing
+from indexes import build_indexes
+from votes import SIGNATURE_COLUMNS,expand_signatures,has_signature_columns
 
 def countVote(vote,groups_of_voters,datasets,signatures):
+    with tracing.span('countVote'):
+        return _countVote(vote,groups_of_voters,datasets,signatures)
 
-    list_of_deals=datasets['deals']
-    list_of_miners=datasets['miners']
-    list_of_addresses_and_ids=datasets['addresses']
+
+def _countVote(vote,groups_of_voters,datasets,signatures):
+
+    datasets=build_indexes(datasets)
+    deal_aggregates=datasets['deal_aggregates']
+    miner_graph=datasets['miner_graph']
+    address_index=datasets['address_index']
     list_of_core_devs=datasets['core']
-    list_of_powers=datasets['powers']
+    multisig_index=datasets.get('multisig_index')
+    balance_index=datasets.get('balance_index')
     
-    signature=json.loads(vote["signature"])
-    X = signature["signer"]
-    signature=utils.addShortAndLongId(signature=signature,
-                list_of_addresses_and_ids=list_of_addresses_and_ids)
+    with tracing.span('countVote.resolve'):
+        signature=_signature(vote)
+        X = signature["signer"]
+        signature=address_index.add_ids(signature)
+        # token weights come from chain state, not from the signature,
+        # unless the signer's balance was never looked up
+        if balance_index is not None:
+            balance=balance_index.balance(signature['short'])
+            signature['submittedBalance']=signature['balance']
+            signature['balanceVerified']=balance is not None
+            if balance is not None:
+                signature['balance']=balance
+            signature['balanceMismatch']=balance is not None and _mismatch(
+                signature['submittedBalance'],balance)
     #
     # checks if it;s a core dev and adds headcount
     #
-    is_core_dev =utils.is_in_list(X, list_of_core_devs)
-    
-    
-    
-    if is_core_dev:
-        groups_of_voters["core"].validateAndAddVote(signature)
+    with tracing.span('countVote.core'):
+        is_core_dev =utils.is_in_list(X, list_of_core_devs)
+        
+        if is_core_dev:
+            groups_of_voters["core"].validateAndAddVote(signature)
     
     #
     # checks if exists and adds balance
     #
     #exists = utils.is_in_list(X, list_of_addresses)
     #if exists:
-    groups_of_voters["token"].validateAndAddVote(signature)
+    with tracing.span('countVote.token'):
+        groups_of_voters["token"].validateAndAddVote(signature)
+        # a signer's vote may complete the approvals of its multisigs
+        if multisig_index is not None:
+            groups_of_voters["token"].approveMultisigs(multisig_index,signature,
+                                                       len(signatures))
     #
     # Iterate over all deals, adding up the bytes of deals where X is the proposer (client)
     #  
-    dealsForX=utils.get_market_deals_from_id(list_of_deals,
-                                             user_id=signature['short'],
-                                             side='client_id') 
-    #print('length {}'.format(len(dealsForX)))
-    totalBytes = dealsForX["unpadded_piece_size"].sum()
-    # checks that address X has not voted and has >0 bytes as a client
-    if totalBytes > 0:
-        groups_of_voters["client"].validateAndAddVote(signature,amount=totalBytes)
+    with tracing.span('countVote.client'):
+        totalBytes=deal_aggregates.client_bytes(signature['short'])
+        # checks that address X has not voted and has >0 bytes as a client
+        if totalBytes > 0:
+            groups_of_voters["client"].validateAndAddVote(signature,amount=totalBytes)
     #
     # Iterate over all SPs, checking if X is the owner / worker of an SP Y
     #
@@ -57,63 +84,50 @@ def countVote(vote,groups_of_voters,datasets,signatures):
     # checks if this is an owner account, and overwrites worker account vote if it is
     #--------------------------------------------------------------------------
     #checks if signature['short'] corresponds to an owner or worker id
-    result,otherID=utils.is_worker_or_owner(Id=signature['short'],
-                                            list_of_miners=list_of_miners)
-    
-    
- 
-    
-    #if it's an owner, override the entries from the worker, if they exist
-    
-    if result=='owner':
-        #gets the other ID in long format
-        otherID_long=utils.longFromShort(otherID, list_of_addresses_and_ids)
-        #if otherID_long is in the address that alread voted, remove
-        for gr in ['capacity','deal']:
-            
-            
-            
-            if (groups_of_voters[gr].has_voted(otherID_long)) and (otherID_long!=signature['signer']):
-                print(' ')
-                print('overwritting '+otherID_long)
-                groups_of_voters[gr].removeVote(otherID_long)
+    with tracing.span('countVote.owner_override'):
+        result,otherID=miner_graph.role(signature['short'])
+        
+        #if it's an owner, override the entries from the worker, if they exist
+        
+        if result=='owner':
+            #gets the other ID in long format
+            otherID_long=address_index.long_from_short(otherID)
+            #if otherID_long is in the address that alread voted, remove
+            for gr in ['capacity','deal']:
+                
+                if (groups_of_voters[gr].has_voted(otherID_long)) and (otherID_long!=signature['signer']):
+                    print(' ')
+                    print('overwritting '+otherID_long)
+                    groups_of_voters[gr].removeVote(otherID_long)
             
     #--------------------------------------------------------------------------
     
-    SPs= utils.get_owners_and_workers(list_of_miners, signature['short'])  
-    #
-    # Add Y's raw bytes to the SP capacity vote (Group 2)
-    #
-    total_power_SPs=0
-    totalBytesY=0
-    other_info={'miner_ids':[]}
-    for Y_i in SPs:
- 
-        power_Y_i=utils.get_power(Y_i, list_of_powers)
-        #if power_Y_i.size>0:
-        total_power_SPs+=power_Y_i
+    with tracing.span('countVote.sp'):
+        SPs= miner_graph.miners_of(signature['short'])
         #
-        # Iterate over all deals, adding up the bytes of deals
-        # where Y is the provider, add these bytes to Deal Storage vote (Group 1)
+        # Add Y's raw bytes to the SP capacity vote (Group 2)
         #
-        
-        
-        dealsByY=utils.get_market_deals_from_id(list_of_deals,
-                                                 user_id=Y_i,
-                                                 side='provider_id')
+        total_power_SPs=0
+        totalBytesY=0
+        other_info={'miner_ids':[]}
+        for Y_i in SPs:
+     
+            power_Y_i=miner_graph.power(Y_i)
+            #if power_Y_i.size>0:
+            total_power_SPs+=power_Y_i
+            #
+            # Iterate over all deals, adding up the bytes of deals
+            # where Y is the provider, add these bytes to Deal Storage vote (Group 1)
+            #
             
+            totalBytesY += deal_aggregates.provider_bytes(Y_i)
+        #
+        # from Add Y's raw bytes to the SP capacity vote (Group 2)
+        #
+            other_info['miner_ids'].append(Y_i)
             
-        
-        
-    
-        totalBytesY += dealsByY["unpadded_piece_size"].sum()
-    #
-    # from Add Y's raw bytes to the SP capacity vote (Group 2)
-    #
-        other_info['miner_ids'].append(Y_i)
-        
-    groups_of_voters["capacity"].validateAndAddVote(signature,amount=total_power_SPs,other_info=other_info)
-    groups_of_voters["deal"].validateAndAddVote(signature,amount=totalBytesY)
+        groups_of_voters["capacity"].validateAndAddVote(signature,amount=total_power_SPs,other_info=other_info)
+        groups_of_voters["deal"].validateAndAddVote(signature,amount=totalBytesY)
     
     
     
@@ -121,4 +135,447 @@ def countVote(vote,groups_of_voters,datasets,signatures):
     
     
     return groups_of_voters,signatures
-    
\ No newline at end of file
+    
+
+def _signature(vote):
+    '''
+    signature of a vote as a dict, read from the columns added by
+    `votes.expand_signatures`, or parsed from its JSON if they are missing
+    '''
+    if 'signer' not in vote:
+        return json.loads(vote["signature"])
+    return {field:vote[column] for field,column in SIGNATURE_COLUMNS.items()}
+
+
+def _mismatch(submitted,balance):
+    try:
+        return int(submitted)!=balance
+    except (TypeError,ValueError):
+        return True
+
+
+def weigh_votes(list_of_votes,datasets,per_id=None):
+    '''
+    computes, for every vote at once, the weight it would carry in each group.
+    This is the part of `countVote` that does not depend on the order of the
+    votes.
+
+    Parameters
+    ----------
+    list_of_votes : pandas.DataFrame
+        votes, as returned by `votes.Votes`. If the signature columns are
+        missing, the signatures are parsed here.
+    datasets : dict
+        as returned by `preprocess.dataPreprocess`.
+    per_id : pandas.DataFrame, optional
+        as returned by `link_totals`, covering at least the signers of
+        `list_of_votes`. Computed here if None.
+
+    Returns
+    -------
+    weights : pandas.DataFrame
+        one row per vote, in the same order, with columns
+        'position', 'signer', 'short', 'long', 'optionName', 'power',
+        'balance', 'submitted_balance', 'balance_verified',
+        'balance_mismatch', 'is_core', 'client', 'role', 'other_long',
+        'capacity', 'deal' and 'miner_ids'.
+        With a 'balance_index' in `datasets`, 'balance' is the balance on
+        chain at the snapshot height and 'balance_mismatch' flags the votes
+        that submitted a different one. Votes whose signer was not looked
+        up keep the submitted balance, with 'balance_verified' False.
+
+    '''
+    datasets=build_indexes(datasets)
+    address_index=datasets['address_index']
+    deal_aggregates=datasets['deal_aggregates']
+    miner_graph=datasets['miner_graph']
+    core_devs=set(datasets['core'])
+
+    if not has_signature_columns(list_of_votes):
+        list_of_votes=expand_signatures(list_of_votes.copy())
+    weights=address_index.resolve_many(list_of_votes['signer'])
+    weights.insert(0,'position',np.arange(len(weights)))
+    weights['optionName']=list_of_votes['optionName'].to_numpy(dtype=object)
+    weights['power']=list_of_votes['signaturePower'].to_numpy(dtype=object)
+    submitted=list_of_votes['signatureBalance'].to_numpy(dtype=object)
+    balance_index=datasets.get('balance_index')
+    if balance_index is None:
+        weights['balance']=submitted
+        weights['submitted_balance']=submitted
+        weights['balance_verified']=False
+        weights['balance_mismatch']=False
+    else:
+        balances=balance_index.balance_many(weights['short'])
+        verified=np.array([balance is not None for balance in balances],dtype=bool)
+        weights['balance']=np.where(verified,balances,submitted)
+        weights['submitted_balance']=submitted
+        weights['balance_verified']=verified
+        weights['balance_mismatch']=np.array(
+            [is_verified and _mismatch(value,balance) for value,balance,is_verified
+             in zip(submitted,balances,verified)],dtype=bool)
+    weights['is_core']=weights['signer'].isin(core_devs).to_numpy()
+    weights['client']=deal_aggregates.total_bytes_many(
+        weights['short'],'client_id').tolist()
+
+    # owner / worker override target
+    worker=np.array([miner_graph.worker_of_owner.get(Id)
+                     for Id in weights['short']],dtype=object)
+    is_owner=np.array([Id in miner_graph.worker_of_owner
+                       for Id in weights['short']],dtype=bool)
+    weights['role']=np.where(is_owner,'owner',None)
+    weights['other_long']=np.where(is_owner,
+                                   address_index.long_from_short_many(worker),
+                                   None)
+
+    # capacity and deal bytes over all the SPs owned or worked by each voter
+    if per_id is None:
+        per_id=link_totals(datasets,weights['short'])
+    per_id=per_id.reindex(weights['short'])
+    weights['capacity']=[0 if pd.isna(power) else power
+                         for power in per_id['capacity'].to_numpy(dtype=object)]
+    weights['deal']=[0 if pd.isna(total) else int(total)
+                     for total in per_id['deal'].to_numpy(dtype=object)]
+    weights['miner_ids']=[ids if isinstance(ids,list) else []
+                          for ids in per_id['miner_ids'].to_numpy(dtype=object)]
+    return weights
+
+
+def link_totals(datasets,ids=None):
+    '''
+    capacity, deal bytes and miners over all the SPs owned or worked by each
+    owner / worker id, in one pass over `miner_graph.links`.
+
+    Parameters
+    ----------
+    datasets : dict
+        with the indexes of `indexes.build_indexes`.
+    ids : iterable, optional
+        only these ids are kept. All the ids of the graph if None.
+
+    Returns
+    -------
+    per_id : pandas.DataFrame
+        indexed by id, with columns 'capacity', 'deal' and 'miner_ids'.
+
+    '''
+    links=datasets['miner_graph'].links
+    if ids is not None:
+        ids=pd.unique(pd.Series(ids,dtype=object).dropna().to_numpy(dtype=object))
+        links=links[links['id'].isin(ids).to_numpy()]
+    codes,uniques=pd.factorize(links['id'])
+    order=np.argsort(codes,kind='stable')
+    order=order[codes[order]>=0]
+    counts=np.bincount(codes[order],minlength=len(uniques))
+    stops=np.cumsum(counts)
+    miners=links['miner_id'].to_numpy(dtype=object)[order]
+    powers=links['raw_byte_power'].to_numpy(dtype=object)[order].tolist()
+    deals=datasets['deal_aggregates'].total_bytes_many(miners,'provider_id').tolist()
+    miners=miners.tolist()
+    capacity,deal,miner_ids=[],[],[]
+    for start,stop in zip(stops-counts,stops):
+        capacity.append(sum(powers[start:stop]))
+        deal.append(sum(deals[start:stop]))
+        miner_ids.append(miners[start:stop])
+    return pd.DataFrame({'capacity':capacity,'deal':deal,'miner_ids':miner_ids},
+                        index=pd.Index(uniques,dtype=object,name='id'),dtype=object)
+
+
+def unverified_balances(weights):
+    '''
+    votes weighted by their submitted balance because the balance of their
+    signer on chain was not looked up, see `preprocess.addVoterBalances`
+    '''
+    return weights.loc[~weights['balance_verified'].to_numpy(dtype=bool),
+                       ['position','signer','short','submitted_balance']]
+
+
+def balance_mismatches(weights):
+    '''
+    votes whose submitted balance differs from the balance on chain at the
+    snapshot height
+
+    Parameters
+    ----------
+    weights : pandas.DataFrame
+        as returned by `weigh_votes`.
+
+    Returns
+    -------
+    mismatches : pandas.DataFrame
+        'position', 'signer', 'short', 'submitted_balance' and 'balance' of
+        those votes.
+
+    '''
+    return weights.loc[weights['balance_mismatch'].to_numpy(dtype=bool),
+                       ['position','signer','short','submitted_balance','balance']]
+
+
+# votes, datasets and link totals of the running `weigh_votes_parallel`.
+# Worker processes are forked, so they read these without copying or
+# pickling them
+_shared={}
+
+
+def available_cpus():
+    '''
+    number of CPUs this process may run on
+    '''
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def weigh_votes_parallel(list_of_votes,datasets,workers:int=None,
+                         shards:int=None):
+    '''
+    same as `weigh_votes`, with the votes split in contiguous shards that are
+    weighed on `workers` processes. The weight of a vote does not depend on
+    the other votes, so the shards are independent; they are concatenated
+    back in order, and everything that depends on the order of the votes
+    (duplicates and owner overrides) is left to `assemble_groups`.
+
+    The indexes and the `link_totals` of every owner / worker are built once
+    here and shared with the workers by forking, and each shard sends back
+    its columns as arrays. This falls back to `weigh_votes` where fork is not
+    available or when fewer than two CPUs are, as the shards then only add
+    the cost of sending the weights back.
+
+    Forking is only safe while no other thread of this process holds a lock
+    (logging, tracing, a database pool). The threads started by
+    `preprocess.dataPreprocess` have finished when it returns, so this must
+    not be called while other threads are running, e.g. from
+    `service.CountingService`, which weighs its votes on one process.
+
+    Parameters
+    ----------
+    list_of_votes : pandas.DataFrame
+        votes, as returned by `votes.Votes`.
+    datasets : dict
+        as returned by `preprocess.dataPreprocess`.
+    workers : int, optional
+        number of processes, at most one per available CPU. One per
+        available CPU if None.
+    shards : int, optional
+        number of shards. Four per worker if None.
+
+    Returns
+    -------
+    weights : pandas.DataFrame
+        identical to the output of `weigh_votes`.
+
+    '''
+    workers=min(workers or available_cpus(),available_cpus())
+    if workers<=1 or 'fork' not in multiprocessing.get_all_start_methods():
+        return weigh_votes(list_of_votes,datasets)
+    datasets=build_indexes(datasets)
+    if not has_signature_columns(list_of_votes):
+        list_of_votes=expand_signatures(list_of_votes.copy())
+    shards=max(1,min(shards or 4*workers,len(list_of_votes)))
+    bounds=np.linspace(0,len(list_of_votes),shards+1).astype(int)
+
+    _shared['votes']=list_of_votes
+    _shared['datasets']=datasets
+    _shared['per_id']=link_totals(datasets)
+    try:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 mp_context=multiprocessing.get_context('fork')) as executor:
+            parts=list(executor.map(_weigh_shard,bounds[:-1],bounds[1:]))
+    finally:
+        _shared.clear()
+    dtypes=parts[0][0]
+    weights=pd.DataFrame({
+        column:pd.Series(np.concatenate([arrays[ii] for _,arrays in parts]),dtype=dtype)
+        for ii,(column,dtype) in enumerate(dtypes.items())})
+    weights['position']=np.arange(len(weights))
+    return weights
+
+
+def _weigh_shard(start,stop):
+    weights=weigh_votes(_shared['votes'].iloc[start:stop],_shared['datasets'],
+                        per_id=_shared['per_id'])
+    return weights.dtypes,[weights[column].to_numpy() for column in weights.columns]
+
+
+def _first_per_signer(weights,eligible):
+    '''
+    votes that are kept in a group where votes are never removed: the first
+    eligible vote of every signer
+    '''
+    candidates=weights[eligible]
+    kept=candidates.drop_duplicates('signer',keep='first')
+    return kept,np.arange(len(kept)),len(candidates)-len(kept)
+
+
+def membership_events(weights):
+    '''
+    replays the add / remove sequence that `countVote` produces in the
+    capacity and deal groups, where an owner's vote removes a previous vote
+    from its worker.
+
+    Parameters
+    ----------
+    weights : pandas.DataFrame
+        as returned by `weigh_votes`.
+
+    Returns
+    -------
+    events : pandas.DataFrame
+        one row per vote or override, in processing order, with columns
+        'position', 'signer', 'kind' ('vote' or 'removal'), 'added',
+        'removed' and 'index' (the length of the group before the event).
+
+    '''
+    votes=pd.DataFrame({'position':weights['position'].to_numpy(),
+                        'signer':weights['signer'].to_numpy(),
+                        'kind':'vote',
+                        'order':1})
+    overrides=weights[weights['role'].eq('owner')
+                      & weights['other_long'].notna()
+                      & weights['other_long'].ne(weights['signer'])]
+    removals=pd.DataFrame({'position':overrides['position'].to_numpy(),
+                           'signer':overrides['other_long'].to_numpy(),
+                           'kind':'removal',
+                           'order':0})
+    events=pd.concat([votes,removals],ignore_index=True)
+    events=events.sort_values(['position','order'],kind='stable',
+                              ignore_index=True)
+    # a signer is in the group right after its own vote and out of it right
+    # after a removal, so each event only depends on the one before it
+    previous=events.groupby('signer',sort=False)['kind'].shift()
+    events['added']=events['kind'].eq('vote') & ~previous.eq('vote')
+    events['removed']=events['kind'].eq('removal') & previous.eq('vote')
+    delta=events['added'].astype(int)-events['removed'].astype(int)
+    events['index']=delta.cumsum()-delta
+    return events.drop(columns='order')
+
+
+def _kept_after_overrides(weights):
+    '''
+    votes that are kept in the capacity and deal groups
+    '''
+    events=membership_events(weights)
+    last=events.drop_duplicates('signer',keep='last')
+    survivors=last.loc[last['kind'].eq('vote'),'signer']
+    adds=events[events['added']]
+    kept=adds[adds['signer'].isin(set(survivors))].drop_duplicates(
+        'signer',keep='last').sort_values('position')
+    ignored=int((events['kind'].eq('vote') & ~events['added']).sum())
+    return (weights.iloc[kept['position'].to_numpy()],
+            kept['index'].to_numpy(),ignored)
+
+
+def _load_group(group,kept,indices,quantities,ignored,other=None):
+    listVotes=[]
+    for ii,(signer,option) in enumerate(zip(kept['signer'],kept['optionName'])):
+        listVotes.append(Vote(signer=signer,
+                              vote=option,
+                              quantity=quantities[ii],
+                              other=other[ii] if other is not None else [],
+                              groupID=group.groupID,
+                              index=int(indices[ii])))
+    group.loadVotes(listVotes,votedMoreThanOnce=ignored*["signer"])
+    return group
+
+
+def count_all(list_of_votes,datasets,workers:int=1):
+    '''
+    counts all votes at once. Gives the same groups as calling `countVote`
+    on every row of `list_of_votes` in order, including an owner's vote
+    overriding an earlier vote from its worker.
+
+    Parameters
+    ----------
+    list_of_votes : pandas.DataFrame
+        votes, as returned by `votes.Votes`.
+    datasets : dict
+        as returned by `preprocess.dataPreprocess`.
+    workers : int, optional
+        number of processes the votes are weighed on, see
+        `weigh_votes_parallel`. None for one per core. The result does not
+        depend on it.
+
+    Returns
+    -------
+    groups_of_voters : dict
+        the 'deal', 'capacity', 'client', 'token' and 'core' groups.
+    weights : pandas.DataFrame
+        per-vote weights, see `weigh_votes`.
+
+    '''
+    with tracing.span('count_all'):
+        with tracing.span('count_all.weigh_votes'):
+            if workers==1:
+                weights=weigh_votes(list_of_votes,datasets)
+            else:
+                weights=weigh_votes_parallel(list_of_votes,datasets,
+                                             workers=workers)
+        with tracing.span('count_all.assemble_groups'):
+            groups_of_voters=assemble_groups(
+                weights,multisig_index=datasets.get('multisig_index'))
+    return groups_of_voters,weights
+
+
+def assemble_groups(weights,multisig_index=None):
+    '''
+    builds the five groups from the per-vote weights of `weigh_votes`. With
+    a `indexes.MultisigIndex`, multisig votes are added to the token group
+    as their signers' votes complete them, see `groups.approveMultisigs`
+    '''
+    groups_of_voters={'deal':groups(1),
+                      'capacity':groups(2),
+                      'client':groups(3),
+                      'token':groups(4),
+                      'core':groups(5)}
+
+    kept,indices,ignored=_first_per_signer(weights,weights['is_core'])
+    _load_group(groups_of_voters['core'],kept,indices,
+                [1]*len(kept),ignored)
+
+    if multisig_index is not None and weights['short'].isin(
+            set(multisig_index.multisigs_of)).any():
+        groups_of_voters['token']=replay_token_votes(weights,multisig_index)
+    else:
+        kept,indices,ignored=_first_per_signer(
+            weights,np.ones(len(weights),dtype=bool))
+        _load_group(groups_of_voters['token'],kept,indices,
+                    [int(balance) for balance in kept['balance']],ignored)
+
+    client=np.array([total>0 for total in weights['client']],dtype=bool)
+    kept,indices,ignored=_first_per_signer(weights,client)
+    _load_group(groups_of_voters['client'],kept,indices,
+                kept['client'].tolist(),ignored)
+
+    kept,indices,ignored=_kept_after_overrides(weights)
+    _load_group(groups_of_voters['capacity'],kept,indices,
+                kept['capacity'].tolist(),ignored,
+                other=[{'miner_ids':list(ids)} for ids in kept['miner_ids']])
+    _load_group(groups_of_voters['deal'],kept,indices,
+                kept['deal'].tolist(),ignored)
+    return groups_of_voters
+
+
+def replay_token_votes(weights,multisig_index):
+    '''
+    builds the token group by adding the votes in order, as `countVote`
+    does, together with the multisig votes they complete. Only the votes of
+    multisig signers look at the multisig approvals
+    '''
+    group=groups(4)
+    multisigs_of=multisig_index.multisigs_of
+    for position,signer,short,option,balance in zip(
+            weights['position'],weights['signer'],weights['short'],
+            weights['optionName'],weights['balance']):
+        if not group.is_ellegible(signer):
+            group.votedMoreThanOnce.append("signer")
+            continue
+        group._add(Vote(signer=signer,
+                        vote=option,
+                        quantity=int(balance),
+                        other=[],
+                        groupID=group.groupID,
+                        index=len(group.votesBySigner)))
+        if short in multisigs_of:
+            group.approveMultisigs(multisig_index,{'signer':signer,'short':short},
+                                   int(position))
+    return group
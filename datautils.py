@@ -6,10 +6,18 @@ Created on Mon Sep 12 09:19:15 2022
 @author: juan
 """
 # imports required libraries
+from collections import Counter
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
 from sentinel import sentinel
+from indexes import AddressIndex,DealAggregates
+from snapshots import SnapshotStore
+from querycache import QueryCache
+import tracing
+
+# typed, per-height snapshots of the datasets below, see snapshots.py
+snapshots=SnapshotStore('datasets')
 
 
 
@@ -24,7 +32,7 @@ def longFromShort(Id:str,list_of_addresses_and_ids:list):
     Id : str
         short id.
     list_of_addresses_and_ids : list
-       a list with addresses and ids
+       a list with addresses and ids, or an indexes.AddressIndex
 
     Returns
     -------
@@ -33,6 +41,8 @@ def longFromShort(Id:str,list_of_addresses_and_ids:list):
 
     '''
     
+    if isinstance(list_of_addresses_and_ids,AddressIndex):
+        return list_of_addresses_and_ids.long_from_short(Id)
     try:
         long=list_of_addresses_and_ids[
             list_of_addresses_and_ids['id']==Id]['address'].values[0]
@@ -73,33 +83,38 @@ def getShortId(signature:dict,list_of_addresses_and_ids:list):
   
 
 
-def addShortAndLongId(signature:dict,list_of_addresses_and_ids:list):
+def addShortAndLongId(signature:dict,list_of_addresses_and_ids):
+    '''
+    adds the 'short' (f0 id) and 'long' (address) fields to a signature,
+    whatever format the signer used
+
+    Parameters
+    ----------
+    signature :  dict
+        dictionary with the signature we want to get ids for
+    list_of_addresses_and_ids : pandas.DataFrame or indexes.AddressIndex
+       table with addresses and Ids, or an index built from it
+
+    Returns
+    -------
+    signature : dict
+        same dictionary with the 'short' and 'long' fields added
+
+    '''
+    
+    if isinstance(list_of_addresses_and_ids,AddressIndex):
+        return list_of_addresses_and_ids.add_ids(signature)
     
     X=signature['signer']
     
     
     if 'f0'==X[:2]:  # checks if starts with f0. If if does, signature is shortformat
-        try:
-           signature['short']=X
-           signature['long']=longFromShort()
-           
-           
-           list_of_addresses_and_ids[
-               list_of_addresses_and_ids['id']==X
-               ]['address'].values[0]
-        except:
-            signature['long']=None
+        signature['short']=X
+        signature['long']=longFromShort(X,list_of_addresses_and_ids)
                
     else:
-        try:
-            signature['long']=X
-            signature['short']=list_of_addresses_and_ids[
-                list_of_addresses_and_ids['address']==X
-                ]['id'].values[0]
-            
-            
-        except:
-            signature['short']=None
+        signature['long']=X
+        signature=getShortId(signature,list_of_addresses_and_ids)
         
     return signature
     
@@ -133,7 +148,7 @@ def is_in_list(x:str,list_:list):
 
 
 
-def connect_to_sentinel(secret_string: str):
+def connect_to_sentinel(secret_string: str, pool_size: int = 5, cache: bool = False):
     """
     creates a connection coursor to the sentinel database
 
@@ -142,24 +157,31 @@ def connect_to_sentinel(secret_string: str):
     secret_string : str
         connection string to connect to sentinel. it should have the form:
         postgres://readonly:j<PASSWORD>@read.lilium.sh:13573/mainnet?sslmode=require
+    pool_size : int
+        number of connections that can be open at the same time
+    cache : bool
+        if True, query results are also cached under datasets/query_cache.
+        Off by default, since the datasets are already saved as snapshots
 
     Returns
     -------
-    db : a sentinel object which is essenyially an sql aclhemy cuorsor connected to sentiel
+    db : a sentinel object which is essenyially an sql aclhemy cuorsor connected to sentiel.
 
     """
     f = open(secret_string, "r")
     NAME_DB = f.read()
 
-    # initializes the class
-    db = sentinel(NAME_DB)
+    # initializes the class, optionally caching query results locally
+    db = sentinel(NAME_DB, cache=QueryCache('datasets/query_cache') if cache else None,
+                  pool_size=pool_size)
     return db
+@tracing.traced()
 def get_miner_locked_funds(database: sentinel, height: int):
     
     
     try:
-        miner_locked=pd.read_csv('datasets/miner_locked.csv')
-    except:
+        miner_locked=snapshots.read('miner_locked_funds',height)
+    except FileNotFoundError:
         print('miner locked balances  not found, querrying sentinel ...')
 
     
@@ -170,7 +192,7 @@ def get_miner_locked_funds(database: sentinel, height: int):
         ORDER BY "height" DESC
        """.format(height)
         miner_locked = database.customQuery(QUERY)
-        miner_locked.to_csv('datasets/miner_locked_funds.csv')
+        snapshots.write('miner_locked_funds',height,miner_locked)
     return miner_locked
         
     
@@ -180,6 +202,7 @@ def get_miner_locked_funds(database: sentinel, height: int):
     
 
 
+@tracing.traced()
 def get_miner_sector_deals(database: sentinel, miner_id: str, height: int):
     """
     Returns a pandas dataframe with information regarding sector deals for
@@ -214,6 +237,7 @@ def get_miner_sector_deals(database: sentinel, miner_id: str, height: int):
     return sector_deals
 
 
+@tracing.traced()
 def get_owned_SPs(database: sentinel,  height: int):
     """
     Get SP addresses owned by or with worker id `owner_id` up until `height`
@@ -234,8 +258,8 @@ def get_owned_SPs(database: sentinel,  height: int):
     """
 
     try:
-        miner_infos=pd.read_csv('datasets/miner_infos.csv')
-    except:
+        miner_infos=snapshots.read('miner_infos',height)
+    except FileNotFoundError:
         print('miner info (owner/worker) not found, querrying sentinel ...')
 
 
@@ -249,7 +273,7 @@ def get_owned_SPs(database: sentinel,  height: int):
         miner_infos=miner_infos.sort_values(by='height')
         miner_infos=miner_infos.groupby(by='miner_id').head(1)
 
-        miner_infos.to_csv('datasets/miner_infos.csv')
+        snapshots.write('miner_infos',height,miner_infos)
     return miner_infos
 
 
@@ -310,6 +334,7 @@ def get_owners_and_workers(data:pd.core.frame.DataFrame,
 
 
 
+@tracing.traced()
 def get_all_power_actors(database: sentinel, height: int):
     """
     generates a list of all miners with their power QAP and RBP
@@ -337,6 +362,7 @@ def get_all_power_actors(database: sentinel, height: int):
     return power_actors
 
 
+@tracing.traced()
 def get_addresses(database: sentinel,height:int):
     """
     Parameters
@@ -353,16 +379,17 @@ def get_addresses(database: sentinel,height:int):
 
     try:
         
-        actors=pd.read_csv('datasets/list_of_addresses.csv')
-    except:
+        actors=snapshots.read('list_of_addresses',height)
+    except FileNotFoundError:
         print('list of addresses not found, querying...')
         QUERY = """SELECT "id", "address" FROM "visor"."id_addresses"  WHERE height<='{}'
         """.format(height)
         actors = database.customQuery(QUERY)
-        actors.to_csv('datasets/list_of_addresses.csv')
+        snapshots.write('list_of_addresses',height,actors)
     return actors
 
 
+@tracing.traced()
 def get_active_power_actors(database: sentinel, height: int):
     """
     generates a list of all active (with deals expiring after max_height) miners with their power QAP and RBP
@@ -381,14 +408,14 @@ def get_active_power_actors(database: sentinel, height: int):
 
     """
     try:
-        active_powers = pd.read_csv("datasets/power_actors.csv")
-    except:
+        active_powers = snapshots.read("power_actors", height)
+    except FileNotFoundError:
         power_actors = get_all_power_actors(database=database, height=height)
         positive_powers = power_actors[power_actors["quality_adj_power"] > 0]
         active_powers = positive_powers.sort_values(
             "height", ascending=False
         ).drop_duplicates("miner_id")
-        active_powers.to_csv("datasets/power_actors.csv")
+        snapshots.write("power_actors", height, active_powers)
     return active_powers
 
 
@@ -429,13 +456,31 @@ def get_market_deals_from_id(market_deals:pd.core.frame.DataFrame,
     return df
 
 
-def get_market_deals(database: sentinel,  height: int):
-    
+@tracing.traced()
+def get_market_deals(database: sentinel,  height: int, columns:list=None):
+    '''
+    returns the market deals active at `height`
+
+    Parameters
+    ----------
+    database : sentinel
+        db : a sentinel object which is essenyially an sql aclhemy cuorsor connected to sentiel
+    height : int
+        cutoff height.
+    columns : list, optional
+        only return these columns. When the snapshot is already on disk the
+        other columns are not read at all.
 
+    Returns
+    -------
+    deals : pandas.DataFrame
+        "piece_cid", "unpadded_piece_size", "client_id", "provider_id", "height"
+
+    '''
     
     try:
-        deals=pd.read_csv('datasets/market_deals.csv')
-    except:
+        deals=snapshots.read('market_deals',height,columns=columns)
+    except FileNotFoundError:
             
         
         print('getting list of market deal proposals...')
@@ -446,11 +491,290 @@ def get_market_deals(database: sentinel,  height: int):
         WHERE "height"<={} AND "end_epoch">={} AND "start_epoch"<={}'''.format(height,height,height)
         
         deals= database.customQuery(query)
-        deals.to_csv('datasets/market_deals.csv')
+        snapshots.write('market_deals',height,deals)
+        if columns is not None:
+            deals=deals[columns]
         
     return deals
 
 
+@tracing.traced()
+def get_deal_aggregates(database: sentinel,  height: int, chunksize:int=1000000):
+    '''
+    returns the total active deal bytes per client and per provider at
+    `height`, without holding the deals in memory: the deals are streamed
+    from sentinel in chunks of `chunksize` rows and folded into the totals as
+    they arrive. Same totals as building indexes.DealAggregates from
+    `get_market_deals`.
+
+    Parameters
+    ----------
+    database : sentinel
+        db : a sentinel object which is essenyially an sql aclhemy cuorsor connected to sentiel
+    height : int
+        cutoff height.
+    chunksize : int, optional
+        number of deals per chunk.
+
+    Returns
+    -------
+    aggregates : indexes.DealAggregates
+
+    '''
+    
+    try:
+        client=snapshots.read('client_deal_bytes',height)
+        provider=snapshots.read('provider_deal_bytes',height)
+    except FileNotFoundError:
+        
+        print('streaming list of market deal proposals...')
+        
+        # the DISTINCT is done by the database, only the columns we sum over
+        # are transferred
+        query='''SELECT "unpadded_piece_size", "client_id", "provider_id"
+        FROM (SELECT DISTINCT "piece_cid",  "unpadded_piece_size",
+        "client_id", "provider_id","height" 
+        FROM "visor"."market_deal_proposals"
+        WHERE "height"<={} AND "end_epoch">={} AND "start_epoch"<={}) AS deals'''.format(height,height,height)
+        
+        client_totals=Counter()
+        provider_totals=Counter()
+        for chunk in database.streamQuery(query,chunksize=chunksize):
+            sizes=chunk['unpadded_piece_size'].astype('int64')
+            client_totals.update(sizes.groupby(chunk['client_id']).sum().to_dict())
+            provider_totals.update(sizes.groupby(chunk['provider_id']).sum().to_dict())
+        
+        client=_totals_frame(client_totals)
+        provider=_totals_frame(provider_totals)
+        snapshots.write('client_deal_bytes',height,client)
+        snapshots.write('provider_deal_bytes',height,provider)
+    
+    return DealAggregates.from_totals(
+        client.set_index('id')['unpadded_piece_size'],
+        provider.set_index('id')['unpadded_piece_size'])
+
+
+def _totals_frame(totals:dict):
+    return pd.DataFrame({'id':list(totals.keys()),
+                         'unpadded_piece_size':list(totals.values())})
+
+
+#
+# Queries that aggregate in sentinel. They return the same results as the
+# functions above, but only transfer per-id totals / one row per miner
+#
+
+def deal_totals_query(height: int, side: str):
+    '''
+    SQL that sums the unpadded size of the deals active at `height` per
+    `side` ('client_id' or 'provider_id'), counting each distinct deal row
+    once as `get_market_deals` does
+    '''
+    return '''SELECT "{side}" AS "id", SUM("unpadded_piece_size") AS "unpadded_piece_size"
+        FROM (SELECT DISTINCT "piece_cid",  "unpadded_piece_size",
+        "client_id", "provider_id","height" 
+        FROM "visor"."market_deal_proposals"
+        WHERE "height"<={height} AND "end_epoch">={height} AND "start_epoch"<={height}) AS deals
+        GROUP BY "{side}"'''.format(side=side,height=height)
+
+
+def latest_power_claims_query(height: int):
+    '''
+    SQL that returns the latest claim with positive quality adjusted power of
+    every miner at `height`
+    '''
+    return '''SELECT DISTINCT ON ("miner_id") "miner_id", "height", "state_root",
+        "raw_byte_power", "quality_adj_power"
+        FROM "visor"."power_actor_claims"
+        WHERE "height"<={} AND "quality_adj_power">0
+        ORDER BY "miner_id", "height" DESC'''.format(height)
+
+
+def miner_owners_query(height: int):
+    '''
+    SQL that returns one owner / worker row per miner at `height`. Like
+    `get_owned_SPs`, it keeps the row with the lowest height
+    '''
+    return '''SELECT DISTINCT ON ("miner_id") "miner_id", "owner_id", "worker_id", "height"
+        FROM "visor"."miner_infos"
+        WHERE "height"<={}
+        ORDER BY "miner_id", "height" ASC'''.format(height)
+
+
+@tracing.traced()
+def get_deal_totals(database: sentinel,  height: int):
+    '''
+    same as `get_deal_aggregates`, but the totals are computed by sentinel
+
+    Returns
+    -------
+    aggregates : indexes.DealAggregates
+
+    '''
+    try:
+        client=snapshots.read('client_deal_bytes',height)
+        provider=snapshots.read('provider_deal_bytes',height)
+    except FileNotFoundError:
+        print('getting deal bytes per client and provider...')
+        client=database.customQuery(deal_totals_query(height,'client_id'))
+        provider=database.customQuery(deal_totals_query(height,'provider_id'))
+        snapshots.write('client_deal_bytes',height,client)
+        snapshots.write('provider_deal_bytes',height,provider)
+    
+    return DealAggregates.from_totals(
+        client.set_index('id')['unpadded_piece_size'].astype('int64'),
+        provider.set_index('id')['unpadded_piece_size'].astype('int64'))
+
+
+@tracing.traced()
+def get_latest_power_claims(database: sentinel,  height: int):
+    '''
+    same as `get_active_power_actors`, but only the latest claim of every
+    miner is transferred instead of the whole claims history
+    '''
+    try:
+        active_powers = snapshots.read("power_actors", height)
+    except FileNotFoundError:
+        print('getting latest power claims...')
+        active_powers = database.customQuery(latest_power_claims_query(height))
+        snapshots.write("power_actors", height, active_powers)
+    return active_powers
+
+
+@tracing.traced()
+def get_miner_owners(database: sentinel,  height: int):
+    '''
+    same as `get_owned_SPs`, but the one-row-per-miner reduction is done by
+    sentinel
+    '''
+    try:
+        miner_infos=snapshots.read('miner_infos',height)
+    except FileNotFoundError:
+        print('getting owner and worker of every miner...')
+        miner_infos=database.customQuery(miner_owners_query(height))
+        snapshots.write('miner_infos',height,miner_infos)
+    return miner_infos
+
+
+@tracing.traced()
+def get_miner_info_history(database: sentinel,  height: int):
+    '''
+    every owner / worker change of every miner up to `height`, i.e.
+    `get_owned_SPs` before keeping one row per miner. See
+    `temporal.MinerHistory`
+    '''
+    try:
+        miner_infos=snapshots.read('miner_info_history',height)
+    except FileNotFoundError:
+        print('getting the history of miner owners and workers...')
+        QUERY = """
+        SELECT "miner_id", "owner_id", "worker_id", "height"
+        FROM "visor"."miner_infos"
+        WHERE "height"<='{}'
+        ORDER BY "height" ASC
+       """.format(height)
+        miner_infos = database.customQuery(QUERY)
+        snapshots.write('miner_info_history',height,miner_infos,schema='miner_infos')
+    return miner_infos
+
+
+@tracing.traced()
+def get_power_claim_history(database: sentinel,  height: int):
+    '''
+    same as `get_all_power_actors`, stored as a snapshot. See
+    `temporal.PowerHistory`
+    '''
+    try:
+        power_actors=snapshots.read('power_claim_history',height)
+    except FileNotFoundError:
+        power_actors=get_all_power_actors(database=database,height=height)
+        snapshots.write('power_claim_history',height,power_actors,schema='power_actors')
+    return power_actors
+
+
+def deal_history_query(min_height: int, max_height: int):
+    '''
+    deals that are active at some height between `min_height` and
+    `max_height`, with their start and end epochs
+    '''
+    return '''SELECT DISTINCT "piece_cid",  "unpadded_piece_size",
+        "client_id", "provider_id", "height", "start_epoch", "end_epoch"
+        FROM "visor"."market_deal_proposals"
+        WHERE "height"<={max_height} AND "end_epoch">={min_height} AND "start_epoch"<={max_height}'''.format(
+        min_height=min_height,max_height=max_height)
+
+
+@tracing.traced()
+def get_deal_history(database: sentinel,  min_height: int, max_height: int):
+    '''
+    returns the market deals active at any height between `min_height` and
+    `max_height`, see `temporal.DealHistory`
+
+    Parameters
+    ----------
+    database : sentinel
+        db : a sentinel object which is essenyially an sql aclhemy cuorsor connected to sentiel
+    min_height : int
+        lowest height of interest.
+    max_height : int
+        highest height of interest.
+
+    Returns
+    -------
+    deals : pandas.DataFrame
+        "piece_cid", "unpadded_piece_size", "client_id", "provider_id",
+        "height", "start_epoch", "end_epoch"
+
+    '''
+    name='deal_history_from_{}'.format(min_height)
+    try:
+        deals=snapshots.read(name,max_height)
+    except FileNotFoundError:
+        print('getting the history of market deal proposals...')
+        deals=database.customQuery(deal_history_query(min_height,max_height))
+        snapshots.write(name,max_height,deals,schema='deal_history')
+    return deals
+
+
+def multisig_query(height: int):
+    '''
+    one row per (multisig, signer) with the threshold and balance of the
+    multisig, from the latest state of every multisig actor at or before
+    `height`. Multisig states are the ones with a `NumApprovalsThreshold`
+    '''
+    return '''SELECT "multisig_id", "signer_id", "threshold", "balance", "height"
+        FROM (SELECT DISTINCT ON ("actors"."id") "actors"."id" AS "multisig_id",
+              CAST("actor_states"."state"->>'NumApprovalsThreshold' AS BIGINT) AS "threshold",
+              "actors"."balance", "actors"."height", "actor_states"."state"->'Signers' AS "signers"
+              FROM "visor"."actors"
+              JOIN "visor"."actor_states"
+              ON "actor_states"."head"="actors"."head" AND "actor_states"."height"="actors"."height"
+              WHERE "actors"."height"<={} AND "actor_states"."state"->>'NumApprovalsThreshold' IS NOT NULL
+              ORDER BY "actors"."id", "actors"."height" DESC) AS "multisigs"
+        CROSS JOIN LATERAL jsonb_array_elements_text("multisigs"."signers") AS "signer_id"'''.format(height)
+
+
+@tracing.traced()
+def get_multisigs(database: sentinel,  height: int):
+    '''
+    returns the signers, threshold and balance of every multisig at
+    `height`, in a single query. See `indexes.MultisigIndex`
+
+    Returns
+    -------
+    multisigs : pandas.DataFrame
+        "multisig_id", "signer_id", "threshold", "balance", "height"
+
+    '''
+    try:
+        multisigs=snapshots.read('multisig_signers',height)
+    except FileNotFoundError:
+        print('getting multisig signers and thresholds...')
+        multisigs=database.customQuery(multisig_query(height))
+        snapshots.write('multisig_signers',height,multisigs)
+    return multisigs
+
+
 def toObs(group,name:str):
     
     tally=group.tally
@@ -471,6 +795,7 @@ def toObs(group,name:str):
 
 
 
+@tracing.traced()
 def get_balances(database: sentinel,  height: int):
     '''
     
@@ -493,8 +818,8 @@ def get_balances(database: sentinel,  height: int):
     
     
     try:
-        balances=pd.read_csv('datasets/balances.csv')
-    except:
+        balances=snapshots.read('balances',height)
+    except FileNotFoundError:
                 
         
         print('getting list of balances proposals...')
@@ -504,9 +829,87 @@ def get_balances(database: sentinel,  height: int):
         WHERE "height"<={}'''.format(height)
         
         balances= database.customQuery(query)
-        balances.to_csv('datasets/balances.csv')
+        snapshots.write('balances',height,balances)
         
     return balances
+
+
+
+def voter_balances_query(ids: list, height: int):
+    '''
+    latest balance at or before `height` of the actors with short ids `ids`.
+    Only one row per id is returned, the reduction is done by sentinel
+    '''
+    return '''SELECT DISTINCT ON ("id") "id", "balance", "height"
+        FROM "visor"."actors"
+        WHERE "height"<={} AND "id" IN ({})
+        ORDER BY "id", "height" DESC'''.format(
+            height, ','.join("'{}'".format(Id) for Id in ids))
+
+
+def _absent_balances(ids: list):
+    '''
+    rows of `get_voter_balances` for ids with no actor: zero balance, height -1
+    '''
+    return pd.DataFrame({'id':pd.Series(ids,dtype=object),
+                         'balance':pd.Series([0]*len(ids),dtype=object),
+                         'height':pd.Series([-1]*len(ids),dtype='int64')})
+
+
+@tracing.traced()
+def get_voter_balances(database: sentinel,  ids: list, height: int,
+                       chunksize: int=10000):
+    '''
+    returns the latest balance at or before `height` of every voter in
+    `ids`, unlike `get_balances` which downloads the history of every actor.
+
+    `chunksize` ids are queried at a time, and sentinel only returns the
+    latest row of each. Ids already in the snapshot at `height`, including
+    the ones that had no actor, are not queried again.
+
+    Parameters
+    ----------
+    database : sentinel
+        sentinel connection.
+    ids : list
+        short ids of the voters. Other values are ignored.
+    height : int
+        snapshot height.
+    chunksize : int, optional
+        ids per query. The default is 10000.
+
+    Returns
+    -------
+    balances : pandas.DataFrame
+        "id", "balance", "height" (of the latest balance change), one row
+        per id. Ids with no actor at `height` have a zero balance and a
+        height of -1.
+
+    '''
+    ids=pd.Series(pd.unique(pd.Series(list(ids),dtype=object).dropna()),dtype=object)
+    ids=ids[ids.str.fullmatch(r'f0\d+').fillna(False).to_numpy(dtype=bool)]
+    try:
+        cached=snapshots.read('voter_balances',height)
+    except FileNotFoundError:
+        cached=None
+    missing=ids if cached is None else ids[~ids.isin(set(cached['id']))]
+    if len(missing)==0 and cached is None:
+        return _absent_balances([])
+    if len(missing)==0:
+        return cached[cached['id'].isin(set(ids))].reset_index(drop=True)
+
+    print('getting the balances of {} voters...'.format(len(missing)))
+    parts=[] if cached is None else [cached]
+    for start in range(0,len(missing),chunksize):
+        chunk=missing.iloc[start:start+chunksize].tolist()
+        found=database.customQuery(voter_balances_query(chunk,height))
+        # recorded, so that they are not queried on every run
+        absent=sorted(set(chunk)-set(found['id']))
+        parts.append(found[['id','balance','height']])
+        parts.append(_absent_balances(absent))
+    balances=pd.concat([part for part in parts if len(part)],ignore_index=True)
+    snapshots.write('voter_balances',height,balances,schema='balances')
+    return balances[balances['id'].isin(set(ids))].reset_index(drop=True)
     
 
 
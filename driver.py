@@ -5,39 +5,35 @@ this is the main update driver
 @author: juan
 """
 
-from groups import groups
-from tqdm import tqdm
-from preprocess import dataPreprocess
-from counting import countVote
+import pandas as pd
+import datautils as utils
+from preprocess import dataPreprocess,historyPreprocess,addVoterBalances
+from counting import count_all,balance_mismatches,unverified_balances
+from checkpoint import Checkpoint,checkpoint_path
+from votes import Votes,getPolls
 
-def recount_all():
+def recount_all(workers:int=1):
     '''
-    recounts votes
+    recounts votes. With `workers` > 1 (or None, for one per available CPU) the votes
+    are weighed on several processes, see `counting.weigh_votes_parallel`;
+    the result is the same
 
     '''
     HEIGHT = 2162760
     datasets=dataPreprocess(height=HEIGHT,sectreString='SecretString.txt')  
     list_of_votes=datasets['votes']
-    N_votes=len(list_of_votes)
-    signatures=[]
-    deal=groups(1)
-    capacity=groups(2)
-    client=groups(3)
-    token=groups(4)
-    core=groups(5)
-    groups_of_voters={
-        'core':core,
-        'token':token,
-        'client':client,
-        'capacity':capacity,
-        'deal':deal
-        }
     print('')
     print('begin counting...')
     print('')
-    for ii in tqdm(range(N_votes)):
-        vote = list_of_votes.iloc[ii]
-        groups_of_voters,signatures=countVote(vote,groups_of_voters,datasets,signatures)
+    groups_of_voters,weights=count_all(list_of_votes,datasets,workers=workers)
+    mismatches=balance_mismatches(weights)
+    if len(mismatches):
+        print('{} votes submitted a balance that differs from the chain at height {}'.format(
+            len(mismatches),HEIGHT))
+    unverified=unverified_balances(weights)
+    if len(unverified):
+        print('{} votes are weighted by their submitted balance, not found on chain'.format(
+            len(unverified)))
     GROUPS=['deal','capacity','client','token','core']
 
     for gr in GROUPS:
@@ -52,4 +48,118 @@ def recount_all():
             pass
         
         print('')
-    return datasets,groups_of_voters
\ No newline at end of file
+    return datasets,groups_of_voters
+
+
+def recount_incremental(pollId:int=16,checkpoint:str=None):
+    '''
+    recounts the votes of poll `pollId`, only applying the ones that are new
+    or changed since the last run. The state of the count is stored in
+    `checkpoint`, by default one file per poll and height (see
+    `checkpoint.checkpoint_path`)
+
+    '''
+    HEIGHT = 2162760
+    checkpoint=checkpoint or checkpoint_path(pollId,HEIGHT)
+    db=utils.connect_to_sentinel(secret_string='SecretString.txt',pool_size=4)
+    datasets=dataPreprocess(height=HEIGHT,sectreString='SecretString.txt',
+                            votes=False,database=db)
+    votes=Votes(pollId=pollId)
+    votes.getVotes()
+    datasets=addVoterBalances(datasets,votes.votes,HEIGHT,database=db)
+    state=Checkpoint.load(checkpoint,height=HEIGHT,pollId=pollId)
+    print('')
+    print('applying new votes...')
+    print('')
+    n_applied=state.update(votes.votes,datasets)
+    print('applied {} new or changed votes'.format(n_applied))
+    state.save(checkpoint)
+    groups_of_voters=state.groups_of_voters
+    GROUPS=['deal','capacity','client','token','core']
+
+    for gr in GROUPS:
+        print('###################')
+        print('Counting '+str(gr))
+        print('###################')
+        print('')
+        print('')
+        try:
+            groups_of_voters[gr].count()
+        except:
+            pass
+        
+        print('')
+    return datasets,groups_of_voters
+
+
+def recount_polls(pollIds:list,height:int=2162760,workers:int=1):
+    '''
+    counts several polls at the same snapshot height. The datasets and
+    indexes are loaded once and shared by every poll, and the votes of all
+    the polls are fetched concurrently, so each extra poll only costs
+    fetching and counting its own votes
+
+    Returns
+    -------
+    datasets : dict
+        as returned by `preprocess.dataPreprocess`, without votes.
+    results : dict
+        pollId -> groups of voters, or None if the poll has no votes.
+
+    '''
+    db=utils.connect_to_sentinel(secret_string='SecretString.txt',pool_size=4)
+    datasets=dataPreprocess(height=height,sectreString='SecretString.txt',
+                            votes=False,database=db)
+    print('getting the votes of polls '+', '.join(str(pollId) for pollId in pollIds))
+    polls=getPolls(pollIds)
+    counted=[list_of_votes for list_of_votes in polls.values() if list_of_votes is not None]
+    if counted:
+        datasets=addVoterBalances(datasets,pd.concat(counted,ignore_index=True),height,
+                                  database=db)
+    GROUPS=['deal','capacity','client','token','core']
+    results={}
+    for pollId,list_of_votes in polls.items():
+        print('')
+        print('###################')
+        print('Poll '+str(pollId))
+        print('###################')
+        if list_of_votes is None:
+            print('no votes')
+            results[pollId]=None
+            continue
+        groups_of_voters,_=count_all(list_of_votes,datasets,workers=workers)
+        for gr in GROUPS:
+            print('Counting '+str(gr))
+            groups_of_voters[gr].count()
+        results[pollId]=groups_of_voters
+    return datasets,results
+
+
+def recount_heights(heights:list,pollId:int=16):
+    '''
+    counts poll `pollId` at several snapshot heights. The history is loaded
+    once for the whole range of heights, and each height is then an
+    as-of-height lookup plus a count, see `temporal.TemporalStore`
+
+    Returns
+    -------
+    results : dict
+        height -> groups of voters.
+
+    '''
+    store=historyPreprocess(min(heights),max(heights),sectreString='SecretString.txt')
+    list_of_votes=getPolls([pollId])[pollId]
+    GROUPS=['deal','capacity','client','token','core']
+    results={}
+    for height in heights:
+        print('')
+        print('###################')
+        print('Height '+str(height))
+        print('###################')
+        datasets=store.datasets_as_of(height)
+        groups_of_voters,_=count_all(list_of_votes,datasets)
+        for gr in GROUPS:
+            print('Counting '+str(gr))
+            groups_of_voters[gr].count()
+        results[height]=groups_of_voters
+    return results
@@ -14,6 +14,9 @@ In a nutshell, given a snapshot of miners in the network at a current height,
     3. Creates a list of N_core fake core devs
     4. Assings a vote to each of these core devs. 
 
+`generateNetwork` instead builds a whole network (addresses, miners, powers,
+deals, core devs and votes) from a seed, without connecting to sentinel.
+
 
 This vote object has the same structure as the one provided bby catalin.
 In particular, this means that a vote is a dict with the following entries:
@@ -51,13 +54,15 @@ from dataclasses import dataclass
 from sentinel import sentinel
 import numpy as np
 import pandas as pd
-import utils
+import datautils as utils
 from tqdm.auto import tqdm
-import random
-import string
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
+LETTERS = b"abcdefghijklmnopqrstuvwxyz"
+# alphabet of the base32 payload of filecoin addresses
+BASE32 = b"abcdefghijklmnopqrstuvwxyz234567"
+
 ###############################
 #
 ###############################
@@ -186,25 +191,47 @@ def generateCoreDevVote(Id: int, str_lng: int, vote_options: list):
     return vote
 
 
-def get_random_string(length: int):
+def get_random_string(length: int, n: int = None, rng: np.random.Generator = None):
     """
-    generates a random string of length `length`
+    generates a random string of length `length`, or `n` of them at once
 
     Parameters
     ----------
     length : int
         length of the string.
+    n : int, optional
+        number of strings. If None, a single string is returned.
+    rng : numpy.random.Generator, optional
+        random generator to draw from.
 
     Returns
     -------
-    result_str: str
-        random string.
+    result_str: str or numpy.ndarray
+        random string, or array of `n` random strings.
 
     """
     # choose from all lowercase letter
-    letters = string.ascii_lowercase
-    result_str = "".join(random.choice(letters) for i in range(length))
-    return result_str
+    result = random_strings(1 if n is None else n, length, LETTERS, rng)
+    return result[0] if n is None else result
+
+
+def random_strings(
+    n: int, length: int, alphabet: bytes, rng: np.random.Generator = None, prefix: str = ""
+):
+    """
+    `n` random strings of length `length` drawn from `alphabet`, each after
+    `prefix`, generated as one array of characters instead of one character
+    at a time
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    symbols = np.frombuffer(alphabet, dtype=np.uint8)
+    chars = np.empty((n, len(prefix) + length), dtype=np.uint8)
+    chars[:, : len(prefix)] = np.frombuffer(prefix.encode(), dtype=np.uint8)
+    # the modulo bias is irrelevant for test data, and random bytes are much
+    # cheaper to draw than bounded integers
+    codes = np.frombuffer(rng.bytes(n * length), dtype=np.uint8).reshape(n, length)
+    chars[:, len(prefix) :] = symbols[codes % len(symbols)]
+    return chars.view("S{}".format(chars.shape[1])).ravel().astype(str)
 
 
 def addOwnerId(miners: pd.core.frame.DataFrame, dataBase: sentinel, height: int):
@@ -225,26 +252,17 @@ def addOwnerId(miners: pd.core.frame.DataFrame, dataBase: sentinel, height: int)
     Returns
     -------
     miners : pd.core.series.Series
-        same as input but with ownerId and workerId fields added
+        same as input but with ownerId and workerId fields added. Miners
+        without an owner/worker at `height` are dropped.
 
     """
-
-    N_SP = len(miners)
-    miners["ownerId"] = N_SP * [[]]
-    miners["workerId"] = N_SP * [[]]
-    miners["msig"] = N_SP * [[]]
-
-    for n in tqdm(range(N_SP)):
-        miner0 = miners.iloc[n]["minerId"]
-        df = utils.getOwnerId(database=dataBase, miner_id=miner0, height=height)
-        try:
-            df = df.iloc[0]
-            miners["ownerId"].iloc[n] = df["owner_id"]
-            miners["workerId"].iloc[n] = df["worker_id"]
-            miners["msig"].loc[n] = df["multi_addresses"]
-        except:  # which happends if no owner/worker associated to that mienrID
-            n += -1
-    return miners
+    # one query for every miner, instead of one per miner
+    owners = utils.get_miner_owners(database=dataBase, height=height)
+    owners = owners[["miner_id", "owner_id", "worker_id"]].rename(
+        columns={"miner_id": "minerId", "owner_id": "ownerId", "worker_id": "workerId"}
+    )
+    miners = miners.drop(columns=["ownerId", "workerId"], errors="ignore")
+    return miners.merge(owners, on="minerId", how="inner")
 
 
 def generateVotes(N_sp: int = 100, N_core: int = 10, height: int = 2144412):
@@ -312,5 +330,290 @@ def generateVotes(N_sp: int = 100, N_core: int = 10, height: int = 2144412):
     return votes_df
 
 
+###############################
+# synthetic networks
+###############################
+# Everything below is generated offline from a seed, as whole arrays, so that
+# networks with millions of deals can be built in seconds (e.g. for
+# `benchmark.py`). Sizes follow heavy-tailed distributions: a few owners
+# control most miners, a few clients make most deals, and power and balances
+# are log-normal.
+
+SECTOR_SIZE = 2**35  # 32GiB
+ATTOFIL = 10**18
+VOTE_OPTIONS = ["Approve", "Reject", "Abstain"]
+
+
+def zipf_choice(rng: np.random.Generator, n: int, size: int, exponent: float = 1.1):
+    """
+    draws `size` integers in [0, n), where i is drawn with probability
+    proportional to 1 / (i + 1) ** exponent
+    """
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    cdf = np.cumsum(weights)
+    return np.minimum(np.searchsorted(cdf, rng.random(size) * cdf[-1]), n - 1)
+
+
+def random_addresses(rng: np.random.Generator, n: int, protocol: str):
+    """
+    `n` distinct long addresses of the given protocol ('1', '2' or '3')
+    """
+    length = 84 if protocol == "3" else 39
+    # the leading characters are the index, so addresses never collide
+    unique = np.char.zfill(np.arange(n).astype(str), 8)
+    payload = random_strings(n, length - 8, BASE32, rng)
+    return np.char.add(np.char.add("f" + protocol, unique), payload)
+
+
+def generateNetwork(
+    n_miners: int = 10000,
+    n_deals: int = 1000000,
+    n_votes: int = 1000,
+    n_core: int = 10,
+    revote_rate: float = 0.05,
+    height: int = 2162760,
+    pollId: int = 16,
+    seed: int = 0,
+):
+    """
+    generates a random but internally consistent network, with no database
+
+    Parameters
+    ----------
+    n_miners : int, optional
+        number of storage providers. The default is 10000.
+    n_deals : int, optional
+        number of active deals. The default is 1000000.
+    n_votes : int, optional
+        number of votes, one per signer. The default is 1000.
+    n_core : int, optional
+        number of core devs, all of which vote. The default is 10.
+    revote_rate : float, optional
+        fraction of the votes that were changed after they were cast, which
+        the API reports as the same vote with a later updatedAt. The
+        default is 0.05.
+    height : int, optional
+        snapshot height. The default is 2162760.
+    pollId : int, optional
+        poll the votes belong to. The default is 16.
+    seed : int, optional
+        seed of the random generator. The default is 0.
+
+    Returns
+    -------
+    network : dict
+        same keys and shapes as `preprocess.dataPreprocess`: 'addresses',
+        'miners', 'powers' and 'deals' like the datautils fetches, 'core' as
+        a list of addresses, and 'votes' as returned by the API (all strings).
+        'miner_history' also has the older owner of the miners that changed
+        owner, like `datautils.get_miner_info_history`.
+
+    """
+    rng = np.random.default_rng(seed)
+    n_owners = max(1, n_miners // 4)
+    n_clients = max(1, n_deals // 200)
+    n_holders = max(1, n_votes)
+
+    # --------------------------------------------------------------------------------
+    # actors: miners, owners, workers, clients and plain token holders, each
+    # with an ID address and, except for miners, a long address
+    kinds = {
+        "miner": n_miners,
+        "owner": n_owners,
+        "worker": n_owners,
+        "client": n_clients,
+        "holder": n_holders,
+    }
+    first = {}
+    total = 1000
+    for kind, n in kinds.items():
+        first[kind] = total
+        total += n
+    ids = np.char.add("f0", np.arange(1000, total).astype(str))
+
+    def id_of(kind, index):
+        return ids[first[kind] - 1000 + index]
+
+    n_accounts = total - 1000 - n_miners
+    protocols = rng.choice(["1", "3"], size=n_accounts, p=[0.7, 0.3])
+    long_addresses = np.empty(n_accounts, dtype=object)
+    for protocol in ["1", "3"]:
+        mask = protocols == protocol
+        long_addresses[mask] = random_addresses(rng, int(mask.sum()), protocol)
+    addresses = pd.DataFrame(
+        {
+            "id": np.concatenate([id_of("miner", np.arange(n_miners)), ids[n_miners:]]),
+            "address": np.concatenate(
+                [random_addresses(rng, n_miners, "2"), long_addresses]
+            ),
+        }
+    )
+
+    # --------------------------------------------------------------------------------
+    # miners: a few owners control most of them. Most miners of an owner
+    # share its worker. Some miners changed owner before `height`, so they
+    # have an older row too
+    owner = zipf_choice(rng, n_owners, n_miners)
+    worker = np.where(
+        rng.random(n_miners) < 0.8, owner, rng.integers(0, n_owners, n_miners)
+    )
+    miner_ids = id_of("miner", np.arange(n_miners))
+    miners = pd.DataFrame(
+        {
+            "miner_id": miner_ids,
+            "owner_id": id_of("owner", owner),
+            "worker_id": id_of("worker", worker),
+            "height": rng.integers(0, height, n_miners),
+        }
+    )
+    changed = rng.random(n_miners) < 0.05
+    previous = pd.DataFrame(
+        {
+            "miner_id": miner_ids[changed],
+            "owner_id": id_of("owner", rng.integers(0, n_owners, int(changed.sum()))),
+            "worker_id": miners["worker_id"].values[changed],
+            "height": miners["height"].values[changed] // 2,
+        }
+    )
+    miner_history = pd.concat([miners, previous], ignore_index=True)
+    miner_history = miner_history.sort_values(
+        by="height", kind="stable", ignore_index=True
+    )
+    # like datautils.get_owned_SPs, the first row of every miner
+    miners = miner_history.groupby("miner_id", sort=False).head(1)
+    miners = miners.reset_index(drop=True)
+
+    # --------------------------------------------------------------------------------
+    # powers: log-normal number of sectors, a tenth of the miners with no power
+    sectors = np.minimum(np.floor(rng.lognormal(4, 2.5, n_miners)), 2**20)
+    sectors[rng.random(n_miners) < 0.1] = 0
+    raw_byte_power = sectors.astype(np.int64) * SECTOR_SIZE
+    verified = rng.random(n_miners) * (rng.random(n_miners) < 0.5)
+    quality_adj_power = raw_byte_power + (
+        9 * verified * raw_byte_power
+    ).astype(np.int64) // SECTOR_SIZE * SECTOR_SIZE
+    powers = pd.DataFrame(
+        {
+            "miner_id": miner_ids,
+            "height": height - rng.integers(0, 2880, n_miners),
+            "state_root": random_strings(n_miners, 52, BASE32, rng, prefix="bafy2bzace"),
+            "raw_byte_power": raw_byte_power,
+            "quality_adj_power": quality_adj_power,
+        }
+    )
+    # datautils.get_active_power_actors drops the claims with no power
+    powers = powers[powers["quality_adj_power"] > 0].reset_index(drop=True)
+
+    # --------------------------------------------------------------------------------
+    # deals: clients are zipf distributed, providers are drawn in proportion
+    # to their power, and pieces are powers of two, mostly large
+    client = zipf_choice(rng, n_clients, n_deals)
+    weights = quality_adj_power.astype(float) + SECTOR_SIZE
+    provider = np.searchsorted(
+        np.cumsum(weights), rng.random(n_deals) * weights.sum(), side="right"
+    )
+    provider = np.minimum(provider, n_miners - 1)
+    log_size = 35 - np.minimum(rng.geometric(0.5, n_deals) - 1, 15)
+    deals = pd.DataFrame(
+        {
+            "piece_cid": random_strings(n_deals, 53, BASE32, rng, prefix="baga6ea4sea"),
+            "unpadded_piece_size": (2**log_size // 128 * 127).astype(np.int64),
+            "client_id": id_of("client", client),
+            "provider_id": miner_ids[provider],
+            "height": rng.integers(max(0, height - 1051200), height + 1, n_deals),
+        }
+    )
+
+    # --------------------------------------------------------------------------------
+    # votes: core devs, owners, workers, clients and holders, signed either
+    # with their long address or, for a tenth of them, their ID address.
+    # The API keeps one vote per signer, so voters are drawn without
+    # replacement
+    core = random_addresses(rng, n_core, "1")
+    # the core devs are accounts too, with the ids after all the others
+    core_ids = np.char.add("f0", np.arange(total, total + n_core).astype(str))
+    addresses = pd.concat(
+        [addresses, pd.DataFrame({"id": core_ids, "address": core})], ignore_index=True
+    )
+    n_first = max(0, n_votes - n_core)
+    shares = {"owner": 0.3, "worker": 0.1, "client": 0.2, "holder": 0.4}
+    pool = np.concatenate([id_of(kind, np.arange(kinds[kind])) for kind in shares])
+    weight = np.concatenate(
+        [np.full(kinds[kind], shares[kind] / kinds[kind]) for kind in shares]
+    )
+    # weighted sampling without replacement: the smallest exponential keys
+    # scaled by the inverse weights
+    keys = rng.exponential(size=len(pool)) / weight
+    n_first = min(n_first, len(pool))
+    if n_first:
+        chosen = np.argpartition(keys, n_first - 1)[:n_first]
+    else:
+        chosen = np.array([], dtype=np.int64)
+    voter_id = pool[np.sort(chosen)].astype(object)
+    long_of = dict(zip(addresses["id"], addresses["address"]))
+    signer = np.array([long_of[Id] for Id in voter_id], dtype=object)
+    by_id = rng.random(len(signer)) < 0.1
+    signer[by_id] = voter_id[by_id]
+    signer = np.concatenate([core.astype(object), signer])
+    signer = signer[rng.permutation(len(signer))][:n_votes]
+    n = len(signer)
+
+    option = rng.choice(VOTE_OPTIONS, size=n, p=[0.6, 0.3, 0.1])
+    balance = pd.Series(
+        (rng.lognormal(2, 3, n) * 1e6).astype(np.int64), dtype=object
+    ) * (ATTOFIL // 10**6)
+    created = pd.Timestamp("2022-09-01") + pd.to_timedelta(
+        np.sort(rng.integers(0, 14 * 24 * 3600 * 1000, n)), unit="ms"
+    )
+    # a revote updates the vote in place: same id, new option, later updatedAt
+    revoted = rng.random(n) < revote_rate
+    updated = created + pd.to_timedelta(
+        np.where(revoted, rng.integers(1, 2 * 24 * 3600 * 1000, n), 0), unit="ms"
+    )
+    created = pd.Series(created.strftime("%Y-%m-%dT%H:%M:%S.%f")).str[:-3] + "Z"
+    updated = pd.Series(updated.strftime("%Y-%m-%dT%H:%M:%S.%f")).str[:-3] + "Z"
+    signer = pd.Series(signer, dtype=object)
+    balance = balance.astype(str)
+    message = pd.Series(random_strings(n, 22, b"0123456789abcdef", rng))
+    signature = (
+        '{"address":"' + signer
+        + '","pollId":"' + str(pollId)
+        + '","constituentGroupId":1,"optionName":"' + pd.Series(option)
+        + '","message":"' + message
+        + '","balance":"' + balance
+        + '","lockedBalance":"0","power":"0","signer":"' + signer
+        + '"}'
+    )
+    votes = pd.DataFrame(
+        {
+            "id": np.arange(n).astype(str),
+            "pollId": str(pollId),
+            "constituentGroupId": "1",
+            "optionId": pd.Series(option).map(
+                {name: str(k) for k, name in enumerate(VOTE_OPTIONS)}
+            ),
+            "address": signer,
+            "signerAddress": signer,
+            "signature": signature,
+            "power": "0",
+            "balance": balance,
+            "lockedBalance": "0",
+            "uploaded": "true",
+            "createdAt": created,
+            "updatedAt": updated,
+        }
+    )
+
+    return {
+        "deals": deals,
+        "miners": miners,
+        "miner_history": miner_history,
+        "addresses": addresses,
+        "votes": votes,
+        "core": list(core),
+        "powers": powers,
+    }
+
+
 if __name__ == "__main__":
     votes = generateVotes()
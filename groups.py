@@ -19,9 +19,10 @@ I.e: if a multisig has 5 signers with threshold as 3, then 3 out of 5 signers mu
 @author: JP. 
 juan.madrigalcianci@protocol.ai
 """
-import pandas as pd
 import numpy as np
 from dataclasses import dataclass
+from bigint import shares
+import tracing
 
 @dataclass
 class Vote:
@@ -33,6 +34,111 @@ class Vote:
     index:int
         
 
+class MultisigApprovals:
+    '''
+    approvals of multisigs by the token holders that voted, updated one
+    signer vote at a time, so that a vote only looks at the multisigs its
+    signer belongs to (see `indexes.MultisigIndex`).
+    
+    A multisig votes for an option once `threshold` of its signers voted
+    for it. If its signers split so that several options reach the
+    threshold, it votes for the one whose threshold-th vote comes first in
+    the poll, so the decision does not depend on the order the votes are
+    applied in (e.g. a revote applied by `checkpoint.Checkpoint`).
+    
+    * `approvals` multisig -> {signer: (option, position, address)} of its
+      signers that voted
+    * `decisions` multisig -> (option, position) it votes for, where
+      position is that of the vote that completed the threshold
+    * `signers` address of a vote in the token group -> its short id
+    '''
+    def __init__(self,index):
+        self.index=index
+        self.approvals={}
+        self.decisions={}
+        self.signers={}
+    
+    
+    def __getstate__(self):
+        # the index belongs to the datasets and is rebound after loading,
+        # see `checkpoint.Checkpoint.update`
+        state=self.__dict__.copy()
+        state['index']=None
+        return state
+    
+    
+    def approve(self,address,short,option,position:int):
+        '''
+        records the vote of `address` (short id `short`) for `option`, at
+        `position` in the poll
+
+        Returns
+        -------
+        changed : list
+            multisigs whose decision changed
+
+        '''
+        if address in self.signers:
+            return []
+        self.signers[address]=short
+        changed=[]
+        for ms in self.index.multisigs(short):
+            approvals=self.approvals.setdefault(ms,{})
+            if short in approvals:
+                continue
+            approvals[short]=(option,position,address)
+            if self._decide(ms):
+                changed.append(ms)
+        return changed
+    
+    
+    def withdraw(self,address):
+        '''
+        withdraws the vote of `address`, e.g. on a revote
+
+        Returns
+        -------
+        changed : list
+            multisigs whose decision changed
+
+        '''
+        short=self.signers.pop(address,None)
+        if short is None:
+            return []
+        changed=[]
+        for ms in self.index.multisigs(short):
+            approvals=self.approvals.get(ms,{})
+            if short not in approvals or approvals[short][2]!=address:
+                continue
+            del approvals[short]
+            if self._decide(ms):
+                changed.append(ms)
+        return changed
+    
+    
+    def _decide(self,ms):
+        '''
+        updates the decision of `ms`; returns whether it changed
+        '''
+        threshold=max(self.index.threshold[ms],1)
+        positions={}
+        for option,position,_ in self.approvals[ms].values():
+            positions.setdefault(option,[]).append(position)
+        reached=[(sorted(votes)[threshold-1],option)
+                 for option,votes in positions.items() if len(votes)>=threshold]
+        decision=None
+        if reached:
+            position,option=min(reached)
+            decision=(option,position)
+        if decision==self.decisions.get(ms):
+            return False
+        if decision is None:
+            del self.decisions[ms]
+        else:
+            self.decisions[ms]=decision
+        return True
+
+
 class groups:
     '''
     This is a generic group object. it takes 
@@ -55,7 +161,21 @@ class groups:
     def __init__(self,groupID):
         self.groupID=groupID
         self.votedMoreThanOnce=[]
-        self.listVotes=[]
+        # votes keyed by signer, in the order they were added
+        self.votesBySigner={}
+        # running totals per option, updated on every add and remove
+        self.tally={}
+        self.votesPerOption={}
+        # token holders only, see `approveMultisigs`
+        self.multisigApprovals=None
+    
+    
+    @property
+    def listVotes(self):
+        '''
+        list of the votes in this group, in the order they were added
+        '''
+        return list(self.votesBySigner.values())
     
     
     def validateAndAddVote(self,signature:dict,amount=None,other_info:dict=[]):
@@ -98,16 +218,106 @@ class groups:
                         quantity=quantity,
                         other=other_info,
                         groupID=self.groupID,
-                        index=len(self.listVotes))
+                        index=len(self.votesBySigner))
                 
                 
-            self.listVotes.append(thisVote)
+            self._add(thisVote)
 
 
         else:
             self.votedMoreThanOnce.append("signer")
     
-            
+    
+    def _add(self,thisVote:Vote):
+        self.votesBySigner[thisVote.signer]=thisVote
+        option=thisVote.vote
+        # python ints, so that the totals never overflow
+        self.tally[option]=self.tally.get(option,0)+int(thisVote.quantity)
+        self.votesPerOption[option]=self.votesPerOption.get(option,0)+1
+    
+    
+    def approveMultisigs(self,multisig_index,signature:dict,position:int):
+        '''
+        token holders only. Counts the vote of `signature`, which must already
+        be in this group, as an approval of the multisigs its signer is a
+        signer of, and adds the vote of every multisig that reaches its
+        threshold, weighted by the balance of the multisig. Multisigs that
+        are signers of other multisigs approve them in turn.
+
+        Parameters
+        ----------
+        multisig_index : indexes.MultisigIndex
+            signers and thresholds of the multisigs at the snapshot height.
+        signature : dict
+            a dictionary with the signature information, including 'short'
+        position : int
+            position of the vote in the poll, see `MultisigApprovals`
+
+        '''
+        thisVote=self.votesBySigner.get(signature['signer'])
+        if thisVote is None:
+            return
+        # pickled groups from before multisigs were counted lack the field
+        if getattr(self,'multisigApprovals',None) is None:
+            self.multisigApprovals=MultisigApprovals(multisig_index)
+        self.multisigApprovals.index=multisig_index
+        self._applyDecisions(self.multisigApprovals.approve(
+            thisVote.signer,signature['short'],thisVote.vote,position))
+    
+    
+    def _applyDecisions(self,changed):
+        '''
+        replaces the votes of the multisigs in `changed` by their current
+        decision
+        '''
+        approvals=self.multisigApprovals
+        for ms in changed:
+            address=approvals.index.long[ms]
+            current=self.votesBySigner.get(address)
+            if current is not None and isinstance(current.other,dict) \
+                    and current.other.get('multisig')==ms:
+                self.removeVote(address)
+            decision=approvals.decisions.get(ms)
+            if decision is None:
+                continue
+            if not self.is_ellegible(address):
+                self.votedMoreThanOnce.append("signer")
+                continue
+            option,position=decision
+            self._add(Vote(signer=address,
+                           vote=option,
+                           quantity=approvals.index.balance[ms],
+                           other={'multisig':ms,'position':position},
+                           groupID=self.groupID,
+                           index=len(self.votesBySigner)))
+            self._applyDecisions(approvals.approve(address,ms,option,position))
+    
+    
+    def loadVotes(self,listVotes:list,votedMoreThanOnce:list=[]):
+        '''
+        replaces the votes stored in this group, e.g. with the output of
+        `counting.count_all`
+
+        Parameters
+        ----------
+        listVotes : list
+            list of Vote objects, in the order they were added
+        votedMoreThanOnce : list
+            one entry per rejected duplicate vote
+
+        '''
+        self.votesBySigner={thisVote.signer:thisVote for thisVote in listVotes}
+        # a plain loop over python ints, which is exact and as fast as
+        # splitting the quantities into limbs, see `bigint`
+        self.tally={}
+        self.votesPerOption={}
+        for thisVote in listVotes:
+            option=thisVote.vote
+            self.tally[option]=self.tally.get(option,0)+int(thisVote.quantity)
+            self.votesPerOption[option]=self.votesPerOption.get(option,0)+1
+        self.votedMoreThanOnce=list(votedMoreThanOnce)
+        self.multisigApprovals=None
+    
     
     def removeVote(self,address):
         '''
@@ -118,15 +328,27 @@ class groups:
         address : str
             signer address of the vote to remove
         '''
-        for vv in self.listVotes:
-            if vv.signer==address:
-                self.listVotes.remove(vv)
+        thisVote=self.votesBySigner.pop(address,None)
+        if thisVote is None:
+            return
+        option=thisVote.vote
+        self.votesPerOption[option]-=1
+        if self.votesPerOption[option]==0:
+            del self.votesPerOption[option]
+            del self.tally[option]
+        else:
+            self.tally[option]-=int(thisVote.quantity)
+        
+        # the multisigs this vote was an approval of may change their vote
+        approvals=getattr(self,'multisigApprovals',None)
+        if approvals is not None:
+            self._applyDecisions(approvals.withdraw(address))
         
     
     
     
     def has_voted(self,address:str):
-        has_voted= not self.is_ellegible(address)
+        has_voted= address in self.votesBySigner
         return has_voted
         
         
@@ -146,10 +368,7 @@ class groups:
 
         '''
         
-        is_it=True
-        for vv in self.listVotes:
-            if address==vv.signer:
-                is_it=False
+        is_it=address not in self.votesBySigner
     
         return is_it
     
@@ -176,17 +395,31 @@ class groups:
         
         
         
+    def percentages(self):
+        '''
+        exact share of the vote of each option
+
+        Returns
+        -------
+        shares : dict
+            option -> fractions.Fraction between 0 and 1
+
+        '''
+        return shares(self.tally)
+    
+    
+    @tracing.traced('groups.count')
     def count(self):
         '''
-        tallies the votes stored in the group.
+        prints the tally of the votes stored in the group. The tally itself is
+        kept up to date on every add and remove, and can be read at any time
+        from `self.tally`.
 
         Returns
         -------
         
 
         '''
-        list_of_votes=pd.DataFrame(self.listVotes)
-        total_votes=list_of_votes['quantity'].sum()
         print('-----------')
         
         if  self.groupID==1 or self.groupID==2 or self.groupID==3:
@@ -196,17 +429,16 @@ class groups:
         else:
             divisor=1
 
-        self.tally = list_of_votes.groupby("vote")["quantity"].sum().to_dict()
-        total_votes = sum(self.tally.values())//divisor
-        for op, voted_for_op in self.tally.items():
-            voted_for_op=voted_for_op/divisor
+        percentages=self.percentages()
+        for op in sorted(self.tally):
+            voted_for_op=self.tally[op]/divisor
             
 
             
             
             print('option: '+str(op))
             print('There were a total of '+str(voted_for_op)+' '+self.getUnits()+' in favor of '+op)
-            print('this represents {}% of the vote'.format(round(100*voted_for_op/(total_votes),2) ))
+            print('this represents {}% of the vote'.format(float(round(100*percentages[op],2))))
             print('-----------')
 
              
@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lookup structures that are built once from the datasets returned by
+`dataPreprocess` and then queried for every vote.
+
+The functions in `datautils` scan a full DataFrame with a boolean mask on each
+call, which is O(rows) per vote. The classes here hash the relevant columns
+once so that every lookup afterwards is O(1).
+
+@author: JP
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class AddressIndex:
+    '''
+    Two-way map between short (f0) ids and long (robust) addresses, built from
+    the output of `datautils.get_addresses`.
+
+    When an id or an address appears more than once in the table the first
+    row wins, which is what the boolean-mask lookups in `datautils` return.
+    '''
+
+    def __init__(self, list_of_addresses_and_ids: pd.core.frame.DataFrame):
+        pairs = list_of_addresses_and_ids[['id', 'address']].dropna()
+        by_id = pairs.drop_duplicates('id', keep='first')
+        by_address = pairs.drop_duplicates('address', keep='first')
+        self.short_to_long = dict(zip(by_id['id'], by_id['address']))
+        self.long_to_short = dict(zip(by_address['address'], by_address['id']))
+
+    def __len__(self):
+        return len(self.short_to_long)
+
+    def long_from_short(self, Id: str):
+        '''
+        returns the long address associated with the short id `Id`, or None
+        '''
+        return self.short_to_long.get(Id)
+
+    def short_from_long(self, address: str):
+        '''
+        returns the short id associated with the long address `address`, or None
+        '''
+        return self.long_to_short.get(address)
+
+    def resolve(self, signer: str):
+        '''
+        resolves a signer, given either as a short id or as a long address
+
+        Parameters
+        ----------
+        signer : str
+            the signer of a vote.
+
+        Returns
+        -------
+        short, long : tuple
+            short id and long address of the signer. Either can be None if it
+            is not in the index.
+
+        '''
+        if is_short(signer):
+            return signer, self.short_to_long.get(signer)
+        return self.long_to_short.get(signer), signer
+
+    def add_ids(self, signature: dict):
+        '''
+        adds the 'short' and 'long' fields to a signature dictionary
+        '''
+        signature['short'], signature['long'] = self.resolve(signature['signer'])
+        return signature
+
+    def long_from_short_many(self, ids):
+        '''
+        vectorized version of `long_from_short`. Returns a numpy array with
+        None where the id is not in the index
+        '''
+        return _map_many(ids, self.short_to_long)
+
+    def short_from_long_many(self, addresses):
+        '''
+        vectorized version of `short_from_long`. Returns a numpy array with
+        None where the address is not in the index
+        '''
+        return _map_many(addresses, self.long_to_short)
+
+    def resolve_many(self, signers):
+        '''
+        vectorized version of `resolve`
+
+        Parameters
+        ----------
+        signers : array-like
+            signers, each either a short id or a long address.
+
+        Returns
+        -------
+        resolved : pandas.DataFrame
+            with columns 'signer', 'short' and 'long', one row per signer and
+            in the same order.
+
+        '''
+        signers = pd.Series(np.asarray(signers, dtype=object), dtype=object)
+        short_format = is_short_many(signers)
+        short = np.where(short_format, signers.to_numpy(),
+                         self.short_from_long_many(signers))
+        long = np.where(short_format, self.long_from_short_many(signers),
+                        signers.to_numpy())
+        return pd.DataFrame({'signer': signers.to_numpy(),
+                             'short': short,
+                             'long': long}, dtype=object)
+
+
+class DealAggregates:
+    '''
+    Total active deal bytes per client and per provider, built once from the
+    output of `datautils.get_market_deals` by grouping on `client_id` and
+    `provider_id`.
+    '''
+
+    SIDES = ('client_id', 'provider_id')
+
+    def __init__(self, market_deals: pd.core.frame.DataFrame = None,
+                 size_column: str = 'unpadded_piece_size'):
+        self.totals = {}
+        self.series = {}
+        if market_deals is None:
+            return
+        for side in self.SIDES:
+            totals = market_deals.groupby(side, sort=False)[size_column].sum()
+            self._set_side(side, totals)
+
+    @classmethod
+    def from_totals(cls, client_totals: pd.core.series.Series,
+                    provider_totals: pd.core.series.Series):
+        '''
+        builds the aggregates from precomputed per-id totals, i.e. two series
+        indexed by client_id and provider_id respectively
+        '''
+        aggregates = cls()
+        aggregates._set_side('client_id', client_totals)
+        aggregates._set_side('provider_id', provider_totals)
+        return aggregates
+
+    def _set_side(self, side: str, totals: pd.core.series.Series):
+        totals = totals.groupby(level=0, sort=False).sum()
+        self.series[side] = totals
+        self.totals[side] = totals.to_dict()
+
+    def total_bytes(self, Id: str, side: str):
+        '''
+        total active deal bytes for `Id`
+
+        Parameters
+        ----------
+        Id : str
+            short id of the client or provider.
+        side : str
+            'client_id' or 'provider_id', determines which side we are looking at
+
+        Returns
+        -------
+        total : int
+            total unpadded piece size, 0 if `Id` has no deals on that side.
+
+        '''
+        return self.totals[side].get(Id, 0)
+
+    def client_bytes(self, Id: str):
+        return self.total_bytes(Id, 'client_id')
+
+    def provider_bytes(self, Id: str):
+        return self.total_bytes(Id, 'provider_id')
+
+    def total_bytes_many(self, ids, side: str):
+        '''
+        vectorized version of `total_bytes`; returns a numpy array aligned
+        with `ids`, with 0 where an id has no deals
+        '''
+        totals = self.series[side]
+        ids = pd.Index(np.asarray(ids, dtype=object), dtype=object)
+        positions = totals.index.get_indexer(ids)
+        values = totals.to_numpy()
+        if len(values) == 0:
+            return np.zeros(len(ids), dtype=np.int64)
+        found = values[np.maximum(positions, 0)]
+        return np.where(positions >= 0, found, 0)
+
+
+class MinerGraph:
+    '''
+    Ownership graph between owner / worker ids and miners, with the raw byte
+    power of every miner attached. Built once from the outputs of
+    `datautils.get_owned_SPs` and `datautils.get_active_power_actors`.
+
+    The answers match `datautils.is_worker_or_owner`,
+    `datautils.get_owners_and_workers` and `datautils.get_power`, including
+    their first-row-wins behaviour when an id appears more than once.
+    '''
+
+    def __init__(self, list_of_miners: pd.core.frame.DataFrame,
+                 list_of_powers: pd.core.frame.DataFrame):
+        miners = list_of_miners[['miner_id', 'owner_id', 'worker_id']]
+
+        first_by_miner = miners.drop_duplicates('miner_id', keep='first')
+        self.owner_and_worker = dict(zip(
+            first_by_miner['miner_id'],
+            zip(first_by_miner['owner_id'], first_by_miner['worker_id'])))
+
+        first_by_owner = miners.drop_duplicates('owner_id', keep='first')
+        first_by_worker = miners.drop_duplicates('worker_id', keep='first')
+        self.worker_of_owner = dict(zip(first_by_owner['owner_id'],
+                                        first_by_owner['worker_id']))
+        self.owner_of_worker = dict(zip(first_by_worker['worker_id'],
+                                        first_by_worker['owner_id']))
+
+        owned = miners[['owner_id', 'miner_id']].drop_duplicates()
+        worked = miners[['worker_id', 'miner_id']].drop_duplicates()
+        self.miners_of_owner = owned.groupby(
+            'owner_id', sort=False)['miner_id'].agg(list).to_dict()
+        self.miners_of_worker = worked.groupby(
+            'worker_id', sort=False)['miner_id'].agg(list).to_dict()
+
+        powers = list_of_powers.drop_duplicates('miner_id', keep='first')
+        self.powers = dict(zip(powers['miner_id'], powers['raw_byte_power']))
+
+        # one row per (id, miner) pair, owned miners before worked ones
+        links = pd.concat([
+            owned.rename(columns={'owner_id': 'id'}).assign(role='owner'),
+            worked.rename(columns={'worker_id': 'id'}).assign(role='worker')],
+            ignore_index=True)
+        links = links.drop_duplicates(['id', 'miner_id'], keep='first')
+        links['raw_byte_power'] = self.power_many(links['miner_id'])
+        self.links = links.reset_index(drop=True)
+
+    def role(self, Id: str):
+        '''
+        checks if `Id` corresponds to a worker or an owner, see
+        `datautils.is_worker_or_owner`
+
+        Returns
+        -------
+        result, otherID : tuple
+            result is 'owner', 'worker' or 'Neither'; otherID is the worker
+            of an owner, the owner of a worker or None.
+
+        '''
+        if Id in self.worker_of_owner:
+            return 'owner', self.worker_of_owner[Id]
+        if Id in self.owner_of_worker:
+            return 'worker', self.owner_of_worker[Id]
+        return 'Neither', None
+
+    def miners_of(self, Id: str):
+        '''
+        returns the list of miner_id that have owner or worker `Id`
+        '''
+        owned = self.miners_of_owner.get(Id, [])
+        worked = self.miners_of_worker.get(Id, [])
+        if not worked:
+            return list(owned)
+        return list(dict.fromkeys(owned + worked))
+
+    def power(self, miner_id: str):
+        '''
+        returns the raw byte power of `miner_id`, 0 if it has no active power
+        '''
+        return self.powers.get(miner_id, 0)
+
+    def power_many(self, miner_ids):
+        '''
+        vectorized version of `power`
+        '''
+        get = self.powers.get
+        return np.array([get(miner_id, 0) for miner_id in miner_ids],
+                        dtype=object)
+
+
+class MultisigIndex:
+    '''
+    Signers, approval threshold and balance of every multisig at the snapshot
+    height, built once from the output of `datautils.get_multisigs`, with
+    the multisigs of every signer so that a vote only looks at the multisigs
+    its signer belongs to.
+
+    Signers and multisigs are keyed by short id.
+    '''
+
+    def __init__(self, multisigs: pd.core.frame.DataFrame,
+                 address_index: AddressIndex = None):
+        rows = multisigs[['multisig_id', 'signer_id', 'threshold', 'balance']]
+        signers = rows['signer_id'].to_numpy(dtype=object)
+        if address_index is not None:
+            signers = np.where(is_short_many(signers), signers,
+                               address_index.short_from_long_many(signers))
+        rows = rows.assign(signer_id=pd.Series(signers, index=rows.index, dtype=object))
+        rows = rows[rows['signer_id'].notna()].drop_duplicates(
+            ['multisig_id', 'signer_id'], keep='first')
+
+        first = rows.drop_duplicates('multisig_id', keep='first')
+        self.threshold = dict(zip(first['multisig_id'],
+                                  (int(t) for t in first['threshold'])))
+        self.balance = dict(zip(first['multisig_id'],
+                                (int(b) for b in first['balance'])))
+        self.signers = rows.groupby('multisig_id', sort=False)[
+            'signer_id'].agg(list).to_dict()
+        self.multisigs_of = rows.groupby('signer_id', sort=False)[
+            'multisig_id'].agg(list).to_dict()
+        self.long = {}
+        for multisig in self.threshold:
+            long = None if address_index is None else address_index.long_from_short(multisig)
+            self.long[multisig] = multisig if long is None else long
+
+    def __len__(self):
+        return len(self.threshold)
+
+    def multisigs(self, Id: str):
+        '''
+        multisigs that the short id `Id` is a signer of
+        '''
+        return self.multisigs_of.get(Id, [])
+
+
+class BalanceIndex:
+    '''
+    on-chain balance at the snapshot height of every voter that was looked
+    up with `datautils.get_voter_balances`. Voters with no actor at that
+    height have a zero balance; voters that were never looked up have none,
+    so that a new voter is not silently weighted 0.
+    '''
+
+    def __init__(self, balances: pd.core.frame.DataFrame):
+        self.balances = {}
+        self.add(balances)
+
+    def __len__(self):
+        return len(self.balances)
+
+    def __contains__(self, Id: str):
+        return Id in self.balances
+
+    def add(self, balances: pd.core.frame.DataFrame):
+        '''
+        adds the balances of more voters, e.g. of new signers
+        '''
+        self.balances.update(zip(balances['id'],
+                                 (int(balance) for balance in balances['balance'])))
+
+    def balance(self, Id: str):
+        '''
+        balance of the short id `Id` in attoFIL, or None if it was not
+        looked up
+        '''
+        return self.balances.get(Id)
+
+    def balance_many(self, ids):
+        '''
+        vectorized version of `balance`, as a numpy array of python ints
+        and None
+        '''
+        return _map_many(ids, self.balances)
+
+
+def is_short(address):
+    '''
+    checks whether `address` is in short (f0) format
+    '''
+    return isinstance(address, str) and address[:2] == 'f0'
+
+
+def is_short_many(addresses):
+    '''
+    vectorized version of `is_short`
+    '''
+    addresses = pd.Series(np.asarray(addresses, dtype=object), dtype=object)
+    return addresses.str[:2].eq('f0').fillna(False).to_numpy(dtype=bool)
+
+
+def _map_many(keys, mapping: dict):
+    get = mapping.get
+    return np.array([get(key) for key in keys], dtype=object)
+
+
+def build_indexes(datasets: dict):
+    '''
+    builds the lookup structures used by the counting code from the raw
+    datasets returned by `dataPreprocess`. Indexes that are already present
+    in `datasets` are left untouched.
+
+    Parameters
+    ----------
+    datasets : dict
+        as returned by `preprocess.dataPreprocess`.
+
+    Returns
+    -------
+    datasets : dict
+        same dict, with the 'address_index', 'deal_aggregates' and
+        'miner_graph' keys added, and 'multisig_index' and
+        'balance_index' if it has 'multisigs' and 'balances'.
+
+    '''
+    if 'address_index' not in datasets:
+        datasets['address_index'] = AddressIndex(datasets['addresses'])
+    if 'deal_aggregates' not in datasets:
+        datasets['deal_aggregates'] = DealAggregates(datasets['deals'])
+    if 'miner_graph' not in datasets:
+        datasets['miner_graph'] = MinerGraph(datasets['miners'],
+                                             datasets['powers'])
+    if 'multisig_index' not in datasets and datasets.get('multisigs') is not None:
+        datasets['multisig_index'] = MultisigIndex(datasets['multisigs'],
+                                                   datasets['address_index'])
+    if 'balance_index' not in datasets and datasets.get('balances') is not None:
+        datasets['balance_index'] = BalanceIndex(datasets['balances'])
+    return datasets
@@ -14,54 +14,269 @@ Preprocess data, this implies either downloading it or loading the following dat
 
 import datautils as utils
 from votes import Votes
+from indexes import build_indexes
+from temporal import TemporalStore
+import tracing
 import pandas as pd
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 
-def dataPreprocess(height:int,sectreString:str):
+def dataPreprocess(height:int,sectreString:str,deal_totals:str=None,pushdown:bool=False,
+                   profile:bool=False,explain:bool=False,votes:bool=True,database=None):
+    '''
+    loads all the datasets needed to count votes at `height`
 
+    Parameters
+    ----------
+    height : int
+        snapshot height.
+    sectreString : str
+        path to the file with the sentinel connection string.
+    deal_totals : str, optional
+        None to download the active deals and aggregate them locally, or
+        'stream' to fold them into per-client and per-provider totals while
+        streaming them from sentinel, without keeping the deals in memory.
+        In that case results['deals'] is None.
+    pushdown : bool, optional
+        if True, deal totals, latest power claims and miner owners are
+        aggregated by sentinel and only the results are transferred.
+        Overrides `deal_totals`.
+    profile : bool, optional
+        if True, every sentinel query is profiled and the report is written
+        to datasets/query_profile.json, see `sentinel.profileReport`.
+    explain : bool, optional
+        if True (and `profile`), also capture EXPLAIN (ANALYZE, BUFFERS) plans.
+    votes : bool, optional
+        if False, the votes are not fetched and results['votes'] is None,
+        e.g. to count several polls against the same datasets with
+        `driver.recount_polls`.
+    database : sentinel, optional
+        connection to use instead of opening one from `sectreString`, e.g.
+        to share it with `addVoterBalances`.
 
+    Returns
+    -------
+    results : dict
+        datasets and lookup indexes. results['timings'] has the time in
+        seconds spent in each fetch.
 
+    '''
+    with tracing.span('dataPreprocess'):
+        return _dataPreprocess(height,sectreString,deal_totals,pushdown,
+                               profile,explain,votes,database)
 
-    #connects to sentinel
-    print('connecting to sentinel..')
-    db = utils.connect_to_sentinel(secret_string=sectreString)
+
+def _dataPreprocess(height,sectreString,deal_totals,pushdown,profile,explain,
+                    votes,database):
+
+
+    #connects to sentinel, with one pooled connection per concurrent query
+    if database is None:
+        print('connecting to sentinel..')
+        database = utils.connect_to_sentinel(secret_string=sectreString,pool_size=4)
+    db = database
+    if profile:
+        db.enableProfiling(explain=explain)
+    
+    #the fetches are independent, so they run concurrently: the cold start
+    #takes about as long as the slowest one
+    fetches={}
     #gets market deals
-    print('getting list of deals...')
-    listDeals=utils.get_market_deals(database=db, height=height)
+    if pushdown:
+        fetches['deal_aggregates']=(utils.get_deal_totals,db,height)
+    elif deal_totals=='stream':
+        fetches['deal_aggregates']=(utils.get_deal_aggregates,db,height)
+    else:
+        fetches['deals']=(_get_deals,db,height)
     #gets miner info
-    print('getting miner info...')
-
-    miner_info=utils.get_owned_SPs(database=db,   height=height)
+    if pushdown:
+        fetches['miners']=(utils.get_miner_owners,db,height)
+    else:
+        fetches['miners']=(utils.get_owned_SPs,db,height)
     #lists addresses
-    print('getting miner and address info...')
-    list_addresses=utils.get_addresses(database=db,   height=height)
+    fetches['addresses']=(utils.get_addresses,db,height)
     #lists get miner power
-    print('getting miner power info...')
-    list_powers=utils.get_active_power_actors(database=db,   height=height)    
-    
-    
-    print('getting list of core devs...')
-    list_core_devs=list(pd.read_csv('datasets/listOfCoreDevs.csv'))
-
+    if pushdown:
+        fetches['powers']=(utils.get_latest_power_claims,db,height)
+    else:
+        fetches['powers']=(utils.get_active_power_actors,db,height)
+    #gets list of core devs and list of votes
+    #signers and thresholds of every multisig, in one query
+    fetches['multisigs']=(utils.get_multisigs,db,height)
+    fetches['core']=(_get_core_devs,)
+    if votes:
+        fetches['votes']=(_get_votes,)
     
-    #gets list of votes
+    print('getting deals, miners, addresses, powers, multisigs, core devs and votes...')
+    fetched,timings=_fetch_all(fetches)
+    for name in fetches:
+        print('{:>16}: {:8.2f} s'.format(name,timings[name]))
+    if profile:
+        db.profileReport('datasets/query_profile.json')
     
-    print('getting list of votes...')
-    
-    votes=Votes() ; votes.update()
-    listVotes=votes.votes
+    listDeals=fetched.get('deals')
+    miner_info=fetched['miners']
+    list_addresses=fetched['addresses']
+    list_powers=fetched['powers']
+    list_core_devs=fetched['core']
+    listVotes=fetched.get('votes')
+    aggregates=fetched.get('deal_aggregates')
 
     results={'deals':listDeals,
              'miners':miner_info,
              'addresses':list_addresses,
              'votes':listVotes,
              'core':list_core_devs,
-             'powers':list_powers}
+             'powers':list_powers,
+             'multisigs':fetched['multisigs']}
+    if aggregates is not None:
+        results['deal_aggregates']=aggregates
+    
+    results['timings']=timings
+    
+    print('building lookup indexes...')
+    with tracing.span('build_indexes'):
+        results=build_indexes(results)
+    
+    #balances on chain of the voters only, now that they are known
+    if listVotes is not None:
+        t0=time.perf_counter()
+        results=addVoterBalances(results,listVotes,height,database=db)
+        timings['balances']=time.perf_counter()-t0
+        print('{:>16}: {:8.2f} s'.format('balances',timings['balances']))
     
     return results
 # gets list of miner, owner, worker
 
 
+def addVoterBalances(datasets:dict,list_of_votes,height:int,sectreString:str=None,
+                     database=None):
+    '''
+    adds the balance on chain at `height` of the voters in `list_of_votes`
+    that are not in datasets['balance_index'] yet, so that the token group
+    is weighted by chain state rather than by the balances submitted with
+    the votes, see `counting.weigh_votes`. Call it again when new signers
+    show up.
+
+    Parameters
+    ----------
+    datasets : dict
+        as returned by `dataPreprocess`.
+    list_of_votes : pandas.DataFrame
+        votes, as returned by `votes.Votes`, e.g. of several polls.
+    height : int
+        snapshot height.
+    sectreString : str, optional
+        path to the file with the sentinel connection string, if no
+        `database` is given.
+    database : sentinel, optional
+        sentinel connection.
+
+    Returns
+    -------
+    datasets : dict
+        same dict, with 'balances' and 'balance_index'.
+
+    '''
+    datasets=build_indexes(datasets)
+    signers=pd.Series(list_of_votes['signer'] if 'signer' in list_of_votes
+                      else [json.loads(signature)['signer']
+                            for signature in list_of_votes['signature']],dtype=object)
+    ids=datasets['address_index'].resolve_many(signers.unique())['short'].dropna()
+    balance_index=datasets.get('balance_index')
+    if balance_index is not None:
+        ids=ids[[Id not in balance_index for Id in ids]]
+    if len(ids)==0 and balance_index is not None:
+        return datasets
+    if database is None:
+        database=utils.connect_to_sentinel(secret_string=sectreString)
+    balances=utils.get_voter_balances(database,ids,height)
+    if balance_index is None:
+        datasets['balances']=balances
+        return build_indexes(datasets)
+    datasets['balances']=pd.concat([datasets['balances'],balances],ignore_index=True)
+    balance_index.add(balances)
+    return datasets
+
+
+def historyPreprocess(min_height:int,max_height:int,sectreString:str):
+    '''
+    loads the history needed to count votes at any height between
+    `min_height` and `max_height`
+
+    Parameters
+    ----------
+    min_height : int
+        lowest height of interest.
+    max_height : int
+        highest height of interest.
+    sectreString : str
+        path to the file with the sentinel connection string.
+
+    Returns
+    -------
+    store : temporal.TemporalStore
+        `store.datasets_as_of(height)` gives the datasets at any height in
+        the range, without re-querying.
+
+    '''
+    print('connecting to sentinel..')
+    db = utils.connect_to_sentinel(secret_string=sectreString,pool_size=4)
+    fetches={'miners':(utils.get_miner_info_history,db,max_height),
+             'powers':(utils.get_power_claim_history,db,max_height),
+             'deals':(utils.get_deal_history,db,min_height,max_height),
+             'addresses':(utils.get_addresses,db,max_height),
+             'core':(_get_core_devs,)}
+    print('getting the history of miners, powers and deals...')
+    with tracing.span('historyPreprocess'):
+        fetched,timings=_fetch_all(fetches)
+    for name in fetches:
+        print('{:>16}: {:8.2f} s'.format(name,timings[name]))
+    print('building as-of-height indexes...')
+    return TemporalStore(miner_infos=fetched['miners'],
+                         power_claims=fetched['powers'],
+                         deals=fetched['deals'],
+                         addresses=fetched['addresses'],
+                         core=fetched['core'])
+
+
+def _get_deals(database,height):
+    return utils.get_market_deals(database=database, height=height,
+                                  columns=['client_id','provider_id','unpadded_piece_size'])
+
+
+def _get_core_devs():
+    return list(pd.read_csv('datasets/listOfCoreDevs.csv'))
+
+
+def _get_votes():
+    votes=Votes() ; votes.update()
+    return votes.votes
+
+
+def _timed(function,*args):
+    t0=time.perf_counter()
+    result=function(*args)
+    return result,time.perf_counter()-t0
+
+
+def _fetch_all(fetches:dict):
+    '''
+    runs every fetch in `fetches` (name -> (function, *args)) on its own
+    thread. Returns the results and the seconds spent in each fetch
+    '''
+    with ThreadPoolExecutor(max_workers=len(fetches)) as executor:
+        futures={name:executor.submit(tracing.propagate(_timed),*fetch)
+                 for name,fetch in fetches.items()}
+        fetched={}
+        timings={}
+        for name,future in futures.items():
+            fetched[name],timings[name]=future.result()
+    return fetched,timings
+
+
 
 if __name__=='__main__':
     HEIGHT=2162760
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local cache for the results of `sentinel.customQuery`.
+
+Results are stored under a key made from a hash of the normalized SQL text
+and its parameters. Since every datautils query has the snapshot height in
+its text, a run at a new height misses the cache and fetches fresh data,
+while repeated runs at the same height never reach the database.
+
+The cache has a size budget; when it is exceeded the least recently used
+results are evicted. An entry that cannot be read back (e.g. truncated by a
+crash) is deleted and treated as a miss.
+
+The cache is opt-in, see `datautils.connect_to_sentinel`: the datasets that
+are saved as Arrow snapshots (snapshots.py) do not need a second copy here.
+
+@author: JP
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import re
+import threading
+import pandas as pd
+
+# what a truncated or corrupt pickle can raise when it is read
+_CORRUPT = (EOFError, pickle.UnpicklingError, ValueError, TypeError,
+            AttributeError, ImportError, IndexError)
+
+# quoted literals and identifiers are kept verbatim when normalizing
+_QUOTED = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+
+
+def normalize_sql(SQL: str):
+    '''
+    collapses all whitespace outside quotes, so that the same query
+    formatted differently gets the same key
+    '''
+    parts = _QUOTED.split(SQL)
+    for ii in range(0, len(parts), 2):
+        parts[ii] = re.sub(r'\s+', ' ', parts[ii])
+    return ''.join(parts).strip()
+
+
+def query_key(SQL: str, params=None):
+    '''
+    cache key for `SQL` with parameters `params`
+    '''
+    payload = json.dumps([normalize_sql(SQL), params], sort_keys=True,
+                         default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class QueryCache:
+    '''
+    on-disk LRU cache of query results
+
+    * `root` directory where results are stored
+    * `max_bytes` size budget of the cache
+    * `hits` / `misses` counters since the cache was created
+    '''
+
+    def __init__(self, root: str = 'datasets/query_cache',
+                 max_bytes: int = 10 * 2**30):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # queries run on several threads, see preprocess._fetch_all
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key: str):
+        return os.path.join(self.root, key + '.pkl')
+
+    def get(self, SQL: str, params=None):
+        '''
+        returns the cached result of `SQL`, or None on a miss
+        '''
+        path = self.path(query_key(SQL, params))
+        try:
+            df = pd.read_pickle(path)
+            # the modification time is used as the last-access time for the LRU
+            os.utime(path)
+        except FileNotFoundError:
+            self._count(hit=False)
+            return None
+        except _CORRUPT:
+            print('discarding a corrupt query cache entry: ' + path)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._count(hit=False)
+            return None
+        self._count(hit=True)
+        return df
+
+    def _count(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def put(self, SQL: str, df: pd.core.frame.DataFrame, params=None):
+        '''
+        stores `df` as the result of `SQL`. The file is written to a temporary
+        name and then renamed, so readers never see a partial result
+        '''
+        path = self.path(query_key(SQL, params))
+        tmp = path + '.tmp'
+        df.to_pickle(tmp)
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self):
+        '''
+        deletes the least recently used results until the cache fits in
+        `max_bytes`
+        '''
+        entries = []
+        for name in os.listdir(self.root):
+            if not name.endswith('.pkl'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.root, name))
+            except FileNotFoundError:
+                # evicted by another thread
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.root, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self):
+        '''
+        returns a dictionary with the hit and miss counts
+        '''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
@@ -14,6 +14,11 @@ as a txt file. You'll need to provide this.
 @author: JP, juan.madrigalcianci@protocol.ai
 """
 
+import inspect
+import json
+import re
+import threading
+import time
 import sqlalchemy as sqa
 import pandas as pd
 
@@ -21,23 +26,162 @@ import pandas as pd
 class sentinel:
     """
     class to connect to the sentinel database.
-    """
-
-    def __init__(self, connString):
-        try:
-            self.connection = sqa.create_engine(connString).connect()
-            print("connected to sentinel")
-        except:
-            print("Error while connecting")
 
+    Queries check out a connection from a pool of up to `pool_size`
+    connections, so several threads can query at the same time.
 
+    If a `querycache.QueryCache` is given, query results are served from it
+    when possible, and the engine is only created on the first query
+    that misses the cache.
+    """
 
-    def customQuery(self, SQL):
+    def __init__(self, connString, cache=None, pool_size=5):
+        self.connString = connString
+        self.cache = cache
+        self.pool_size = pool_size
+        self.engine = None
+        self._lock = threading.Lock()
+        self.profiling = False
+        self.explain = False
+        self.profile = []
+
+    def enableProfiling(self, explain=False):
+        """
+        starts recording, for every query, its wall time, rows and bytes
+        returned and the function that issued it, see `profileReport`.
+
+        If `explain` is True, the plan of every query that reaches the
+        database is also captured with EXPLAIN (ANALYZE, BUFFERS). Notice
+        that ANALYZE runs the query a second time.
+        """
+        self.profiling = True
+        self.explain = explain
+
+    def disableProfiling(self):
+        self.profiling = False
+        self.explain = False
+
+    def connect(self):
+        with self._lock:
+            if self.engine is None:
+                try:
+                    self.engine = sqa.create_engine(
+                        self.connString, pool_size=self.pool_size,
+                        pool_pre_ping=True)
+                    print("connected to sentinel")
+                except:
+                    print("Error while connecting")
+        return self.engine
+
+
+
+    def customQuery(self, SQL, params=None):
         # print('performing custom query...')
-        df = pd.read_sql(SQL, self.connection)
+        t0 = time.perf_counter()
+        if self.cache is not None:
+            df = self.cache.get(SQL, params)
+            if df is not None:
+                if self.profiling:
+                    self._record(SQL, params, t0, df, source="cache")
+                return df
+        with self.connect().connect() as connection:
+            df = pd.read_sql(SQL, connection, params=params)
+        if self.profiling:
+            self._record(SQL, params, t0, df, source="database")
+        if self.cache is not None:
+            self.cache.put(SQL, df, params)
         # print('done!')
         return df
 
+    def streamQuery(self, SQL, chunksize=1000000, params=None):
+        """
+        runs `SQL` with a server-side cursor and yields the result in
+        dataframes of at most `chunksize` rows, so that only one chunk is in
+        memory at a time. Results are not cached.
+        """
+        t0 = time.perf_counter()
+        rows = 0
+        size = 0
+        with self.connect().connect() as connection:
+            connection = connection.execution_options(stream_results=True)
+            for chunk in pd.read_sql(SQL, connection, params=params,
+                                     chunksize=chunksize):
+                if self.profiling:
+                    rows += len(chunk)
+                    size += int(chunk.memory_usage(deep=True).sum())
+                yield chunk
+        if self.profiling:
+            self._record(SQL, params, t0, None, source="stream",
+                         rows=rows, size=size)
+
+    def _record(self, SQL, params, t0, df, source, rows=None, size=None):
+        """
+        adds one query to the profile
+        """
+        entry = {
+            "caller": _caller(),
+            "source": source,
+            "seconds": time.perf_counter() - t0,
+            "rows": len(df) if rows is None else rows,
+            # size of the result once loaded, as a proxy for the transfer
+            "bytes": int(df.memory_usage(deep=True).sum()) if size is None else size,
+            "sql": SQL,
+        }
+        if self.explain and source != "cache":
+            entry["plan"] = self.explainQuery(SQL, params)
+            entry["seq_scans"] = re.findall(r"Seq Scan on (\S+)", entry["plan"])
+        with self._lock:
+            self.profile.append(entry)
+
+    def explainQuery(self, SQL, params=None):
+        """
+        returns the text of EXPLAIN (ANALYZE, BUFFERS) for `SQL`
+        """
+        with self.connect().connect() as connection:
+            plan = pd.read_sql("EXPLAIN (ANALYZE, BUFFERS) " + SQL,
+                               connection, params=params)
+        return "\n".join(plan.iloc[:, 0].astype(str))
+
+    def profileReport(self, path="datasets/query_profile.json"):
+        """
+        writes the queries recorded since `enableProfiling` to `path` as
+        JSON, with totals per calling function, slowest first
+
+        Returns
+        -------
+        report : dict
+            'summary' with per-caller totals and 'queries' with every query.
+        """
+        with self._lock:
+            queries = list(self.profile)
+        summary = {}
+        for entry in queries:
+            total = summary.setdefault(
+                entry["caller"], {"queries": 0, "seconds": 0.0, "rows": 0, "bytes": 0})
+            total["queries"] += 1
+            total["seconds"] += entry["seconds"]
+            total["rows"] += entry["rows"]
+            total["bytes"] += entry["bytes"]
+        summary = dict(sorted(summary.items(), key=lambda kv: -kv[1]["seconds"]))
+        report = {"summary": summary, "queries": queries}
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        return report
+
+
+def _caller():
+    """
+    name of the first function outside this module in the current stack,
+    i.e. the datautils function that issued the query
+    """
+    frame = inspect.currentframe()
+    while frame is not None and frame.f_code.co_filename == __file__:
+        frame = frame.f_back
+    if frame is None:
+        return "unknown"
+    module = frame.f_globals.get("__name__", "")
+    return "{}.{}".format(module, frame.f_code.co_name)
+
 
 
 
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Vote counting daemon. Loads the snapshot and indexes once, polls the votes
+API every `interval` seconds, applies the new and changed votes to a
+`checkpoint.Checkpoint`, and serves the current tallies over HTTP:
+
+    GET /tallies   per-group tallies, shares and turnout, and last update
+    GET /health    'ok'
+
+After every poll the response is serialized once and published by swapping a
+single reference, so requests only ever write out bytes that are already
+there and never wait for ingestion.
+
+    python service.py --height 2162760 --poll 16 --port 8036
+
+@author: JP
+"""
+
+import argparse
+import json
+import threading
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from checkpoint import Checkpoint, checkpoint_path
+import datautils as utils
+from preprocess import addVoterBalances, dataPreprocess
+from votes import Votes, VotesClient
+
+GROUPS = ['deal', 'capacity', 'client', 'token', 'core']
+
+
+class TallyService:
+    '''
+    keeps the count of poll `pollId` at `height` up to date and serves it.
+
+    * `datasets` as returned by `preprocess.dataPreprocess`; loaded on
+      `start`, without votes, if None
+    * `interval` seconds between polls of the votes API
+    * `checkpoint` path where the state of the count is saved after every
+      poll that changed it, so a restart does not recount from scratch. One
+      file per poll and height if None, see `checkpoint.checkpoint_path`
+    '''
+
+    def __init__(self, height: int, sectreString: str = 'SecretString.txt',
+                 pollId: int = 16, interval: float = 60,
+                 checkpoint: str = None,
+                 client: VotesClient = None, datasets: dict = None):
+        self.height = height
+        self.sectreString = sectreString
+        self.pollId = pollId
+        self.interval = interval
+        self.checkpoint = checkpoint or checkpoint_path(pollId, height)
+        self.votes = Votes(pollId=pollId, client=client)
+        self.datasets = datasets
+        self.database = None
+        self.state = None
+        self.lastError = None
+        self._lastVote = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._payload = json.dumps({'status': 'loading'}).encode()
+
+    @property
+    def payload(self):
+        '''
+        JSON of the latest count, as bytes
+        '''
+        return self._payload
+
+    def start(self):
+        '''
+        loads the datasets and the checkpoint, applies the current votes of
+        poll `pollId` and starts polling on a background thread
+        '''
+        if self.datasets is None:
+            self.database = utils.connect_to_sentinel(
+                secret_string=self.sectreString, pool_size=4)
+            self.datasets = dataPreprocess(height=self.height,
+                                           sectreString=self.sectreString,
+                                           votes=False, database=self.database)
+        self.state = Checkpoint.load(self.checkpoint, height=self.height,
+                                     pollId=self.pollId)
+        self.poll()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.votes.client.close()
+
+    def poll(self):
+        '''
+        fetches the votes once and applies the new and changed ones.
+        Returns the number of votes applied
+        '''
+        previous = self.votes.votes
+        self.votes.getVotes()
+        if self.votes.votes is previous:
+            # 304, nothing changed
+            self._publish()
+            return 0
+        return self.apply(self.votes.votes)
+
+    def apply(self, list_of_votes):
+        '''
+        applies the new and changed votes in `list_of_votes` and publishes
+        the result
+        '''
+        self._addBalances(list_of_votes)
+        n_applied = self.state.update(list_of_votes, self.datasets)
+        if n_applied:
+            self.state.save(self.checkpoint)
+        self._lastVote = _last_vote(list_of_votes)
+        self._publish()
+        return n_applied
+
+    def _addBalances(self, list_of_votes):
+        # new signers are weighted by their balance on chain too. If it
+        # cannot be fetched, their votes keep the submitted balance (see
+        # `counting.weigh_votes`) and the next poll tries again. Datasets
+        # given without balances are left as they are
+        if self.datasets.get('balance_index') is None and self.database is None:
+            return
+        try:
+            if self.database is None:
+                self.database = utils.connect_to_sentinel(secret_string=self.sectreString)
+            self.datasets = addVoterBalances(self.datasets, self.state.pending(list_of_votes),
+                                             self.height, database=self.database)
+        except Exception as error:
+            self.lastError = '{}: {}'.format(type(error).__name__, error)
+            print('could not get the balances of the new voters: ' + self.lastError)
+
+    def snapshot(self):
+        '''
+        current count as a dict
+        '''
+        groups_of_voters = self.state.groups_of_voters
+        tallies = {}
+        for gr in GROUPS:
+            group = groups_of_voters[gr]
+            tallies[gr] = {'tally': dict(sorted(group.tally.items())),
+                           'shares': {option: float(share) for option, share
+                                      in sorted(group.percentages().items())},
+                           'voters': len(group.votesBySigner),
+                           'votesPerOption': dict(sorted(group.votesPerOption.items()))}
+        return {'status': 'ok',
+                'pollId': self.pollId,
+                'height': self.height,
+                'votes': len(self.state.position),
+                'voters': len(groups_of_voters['token'].votesBySigner),
+                'lastVote': self._lastVote,
+                'lastUpdate': datetime.now(timezone.utc).isoformat(),
+                'lastError': self.lastError,
+                'groups': tallies}
+
+    def _publish(self):
+        # a single reference assignment, so readers see the old or the new
+        # payload, never a partial one
+        self._payload = json.dumps(self.snapshot()).encode()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                n_applied = self.poll()
+                self.lastError = None
+                if n_applied:
+                    print('applied {} new or changed votes'.format(n_applied))
+            except Exception as error:
+                # keep serving the last count
+                self.lastError = '{}: {}'.format(type(error).__name__, error)
+                print('poll failed: ' + self.lastError)
+
+    def serve(self, host: str = '127.0.0.1', port: int = 8036):
+        '''
+        returns an HTTP server for this service. Call `serve_forever` on it
+        '''
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, so polling clients do not reconnect on every read,
+            # and no Nagle delay between the headers and the body
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                if self.path in ('/', '/tallies'):
+                    body, content_type = service.payload, 'application/json'
+                elif self.path == '/health':
+                    body, content_type = b'ok', 'text/plain'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return ThreadingHTTPServer((host, port), Handler)
+
+
+def _last_vote(list_of_votes):
+    if 'updatedAt' not in list_of_votes or len(list_of_votes) == 0:
+        return None
+    return str(list_of_votes['updatedAt'].max())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='serves the live vote count')
+    parser.add_argument('--height', type=int, default=2162760)
+    parser.add_argument('--poll', type=int, default=16)
+    parser.add_argument('--interval', type=float, default=60)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8036)
+    args = parser.parse_args()
+
+    service = TallyService(height=args.height, pollId=args.poll,
+                           interval=args.interval)
+    service.start()
+    server = service.serve(args.host, args.port)
+    print('serving on http://{}:{}/tallies'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
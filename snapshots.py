@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-disk store for the datasets we download from sentinel.
+
+Each dataset is saved for one snapshot height as an uncompressed Arrow IPC
+file (`datasets/<name>_<height>.arrow`) with typed columns. Reads are memory
+mapped and only materialize the requested columns, so loading the columns
+the counter needs out of a multi-GB deals snapshot does not parse or copy
+the rest of the file.
+
+Needs: pyarrow
+pip install pyarrow
+
+@author: JP
+"""
+
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+
+# attoFIL amounts do not fit in an int64
+ATTOFIL = pa.decimal128(38, 0)
+
+SCHEMAS = {
+    'market_deals': {'piece_cid': pa.string(),
+                     'unpadded_piece_size': pa.int64(),
+                     'client_id': pa.string(),
+                     'provider_id': pa.string(),
+                     'height': pa.int64()},
+    'miner_infos': {'miner_id': pa.string(),
+                    'owner_id': pa.string(),
+                    'worker_id': pa.string(),
+                    'height': pa.int64()},
+    'list_of_addresses': {'id': pa.string(),
+                          'address': pa.string()},
+    'power_actors': {'miner_id': pa.string(),
+                     'height': pa.int64(),
+                     'state_root': pa.string(),
+                     'raw_byte_power': pa.int64(),
+                     'quality_adj_power': pa.int64()},
+    'deal_history': {'piece_cid': pa.string(),
+                     'unpadded_piece_size': pa.int64(),
+                     'client_id': pa.string(),
+                     'provider_id': pa.string(),
+                     'height': pa.int64(),
+                     'start_epoch': pa.int64(),
+                     'end_epoch': pa.int64()},
+    'client_deal_bytes': {'id': pa.string(),
+                          'unpadded_piece_size': pa.int64()},
+    'provider_deal_bytes': {'id': pa.string(),
+                            'unpadded_piece_size': pa.int64()},
+    'balances': {'id': pa.string(),
+                 'balance': ATTOFIL,
+                 'height': pa.int64()},
+    'multisig_signers': {'multisig_id': pa.string(),
+                         'signer_id': pa.string(),
+                         'threshold': pa.int64(),
+                         'balance': ATTOFIL,
+                         'height': pa.int64()},
+    'miner_locked_funds': {'miner_id': pa.string(),
+                           'height': pa.int64(),
+                           'pre_commit_deposits': ATTOFIL,
+                           'initial_pledge': ATTOFIL,
+                           'locked_funds': ATTOFIL},
+}
+
+
+class SnapshotStore:
+    '''
+    store of dataset snapshots, one file per dataset and height, under `root`
+    '''
+
+    def __init__(self, root: str = 'datasets'):
+        self.root = root
+
+    def path(self, name: str, height: int):
+        return os.path.join(self.root, '{}_{}.arrow'.format(name, height))
+
+    def exists(self, name: str, height: int):
+        return os.path.exists(self.path(name, height))
+
+    def write(self, name: str, height: int, df: pd.core.frame.DataFrame,
+              schema: str = None):
+        '''
+        saves `df` as the snapshot of dataset `name` at `height`. Columns
+        listed in `SCHEMAS[schema]` (`SCHEMAS[name]` by default) are stored
+        with that type; the index is not stored.
+        '''
+        os.makedirs(self.root, exist_ok=True)
+        table = to_table(df, SCHEMAS.get(schema or name, {}))
+        path = self.path(name, height)
+        tmp = path + '.tmp'
+        with pa.OSFile(tmp, 'wb') as sink:
+            with ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp, path)
+
+    def read(self, name: str, height: int, columns: list = None):
+        '''
+        loads the snapshot of dataset `name` at `height`
+
+        Parameters
+        ----------
+        name : str
+            dataset name, e.g. 'market_deals'.
+        height : int
+            snapshot height.
+        columns : list, optional
+            columns to load. All of them if None.
+
+        Raises
+        ------
+        FileNotFoundError
+            if there is no such snapshot.
+
+        Returns
+        -------
+        df : pandas.DataFrame
+
+        '''
+        with pa.memory_map(self.path(name, height), 'r') as source:
+            table = ipc.open_file(source).read_all()
+            if columns is not None:
+                table = table.select(columns)
+            return table.to_pandas()
+
+
+def to_table(df: pd.core.frame.DataFrame, schema: dict):
+    '''
+    converts `df` to an arrow table, casting the columns in `schema` to the
+    given types
+    '''
+    arrays = {}
+    for column in df.columns:
+        values = df[column]
+        arrow_type = schema.get(column)
+        if arrow_type is None:
+            arrays[column] = pa.array(values, from_pandas=True)
+        elif pa.types.is_string(arrow_type):
+            arrays[column] = pa.array(values.astype(object).where(values.notna(), None),
+                                      type=arrow_type, from_pandas=True)
+        elif values.dtype == object:
+            # numeric columns from sentinel come back as Decimal or str
+            arrays[column] = pa.array([None if pd.isna(v) else int(v) for v in values],
+                                      type=arrow_type)
+        else:
+            arrays[column] = pa.array(values, type=arrow_type, from_pandas=True)
+    return pa.table(arrays)
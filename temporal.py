@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+As-of-height indexes over the height-stamped history that sentinel keeps,
+so that the same poll can be counted at several heights after loading the
+history once.
+
+* `MinerHistory` over `miner_infos`: owner and worker of every miner at H
+* `PowerHistory` over `power_actor_claims`: latest claim of every miner at H
+* `DealHistory` over `market_deal_proposals`: deals active at H and per-id
+  deal bytes at H
+
+Rows are grouped by key and sorted by height within each group, so the row
+of every key that is current at H is found with one binary search over the
+whole table, and per-id deal bytes come from prefix sums over deal start and
+end epochs. `TemporalStore.datasets_as_of(H)` returns the same datasets as
+`preprocess.dataPreprocess(H)`, ready for `counting.count_all`.
+
+@author: JP
+"""
+
+import numpy as np
+import pandas as pd
+from indexes import AddressIndex, DealAggregates, build_indexes
+
+# heights are below 2**32, so (group, height) pairs are packed in one int64
+_SCALE = np.int64(2**32)
+
+
+class _Timeline:
+    '''
+    rows grouped by `codes` and sorted by height within each group
+    '''
+
+    def __init__(self, codes, heights, n_groups: int):
+        codes = np.asarray(codes, dtype=np.int64)
+        heights = np.asarray(heights, dtype=np.int64)
+        # lexsort is stable, so rows at the same height keep their order
+        self.order = np.lexsort((heights, codes))
+        self.codes = codes[self.order]
+        self.heights = heights[self.order]
+        self.packed = self.codes * _SCALE + self.heights
+        groups = np.arange(n_groups, dtype=np.int64)
+        self.starts = np.searchsorted(self.codes, groups, side='left')
+        self.stops = np.searchsorted(self.codes, groups, side='right')
+        self._queries = groups * _SCALE
+
+    def latest(self, height: int):
+        '''
+        sorted position of the last row at or below `height` in every group,
+        or -1 for groups with none
+        '''
+        last = np.searchsorted(self.packed, self._queries + height, side='right') - 1
+        return np.where(last >= self.starts, last, -1)
+
+    def earliest(self, height: int):
+        '''
+        sorted position of the first row of every group, or -1 if it is
+        above `height`
+        '''
+        first = self.starts.copy()
+        valid = (first < self.stops)
+        valid[valid] = self.heights[first[valid]] <= height
+        return np.where(valid, first, -1)
+
+    def count_upto(self, height: int):
+        '''
+        sorted position one past the last row at or below `height` in
+        every group
+        '''
+        return np.searchsorted(self.packed, self._queries + height, side='right')
+
+
+class MinerHistory:
+    '''
+    owner and worker of every miner at any height, from the `miner_infos`
+    history (all rows up to the largest height of interest)
+    '''
+
+    def __init__(self, miner_infos: pd.core.frame.DataFrame):
+        self.rows = miner_infos[['miner_id', 'owner_id', 'worker_id', 'height']].reset_index(drop=True)
+        codes, self.miner_ids = pd.factorize(self.rows['miner_id'])
+        self.code_of = {miner: code for code, miner in enumerate(self.miner_ids)}
+        self.timeline = _Timeline(codes, self.rows['height'].to_numpy(),
+                                  len(self.miner_ids))
+
+    def as_of(self, height: int, latest: bool = False):
+        '''
+        one row per miner known at `height`, sorted by height
+
+        Parameters
+        ----------
+        height : int
+            snapshot height.
+        latest : bool, optional
+            if False, the first row of every miner, as `datautils.get_owned_SPs`
+            returns; if True, its last row at or below `height`.
+
+        Returns
+        -------
+        miners : pandas.DataFrame
+            "miner_id", "owner_id", "worker_id", "height"
+
+        '''
+        timeline = self.timeline
+        positions = timeline.latest(height) if latest else timeline.earliest(height)
+        rows = timeline.order[positions[positions >= 0]]
+        rows = rows[np.lexsort((rows, self.rows['height'].to_numpy()[rows]))]
+        return self.rows.iloc[rows].reset_index(drop=True)
+
+    def owner(self, miner_id: str, height: int, latest: bool = False):
+        '''
+        (owner_id, worker_id) of `miner_id` at `height`, or None
+        '''
+        code = self.code_of.get(miner_id)
+        if code is None:
+            return None
+        timeline = self.timeline
+        start, stop = timeline.starts[code], timeline.stops[code]
+        if latest:
+            position = start + np.searchsorted(timeline.heights[start:stop], height,
+                                               side='right') - 1
+        else:
+            position = start
+        if position < start or timeline.heights[position] > height:
+            return None
+        row = self.rows.iloc[timeline.order[position]]
+        return row['owner_id'], row['worker_id']
+
+
+class PowerHistory:
+    '''
+    latest positive power claim of every miner at any height, from the
+    `power_actor_claims` history
+    '''
+
+    def __init__(self, power_claims: pd.core.frame.DataFrame):
+        # `datautils.get_active_power_actors` drops the claims with no power
+        # before taking the latest one
+        claims = power_claims[power_claims['quality_adj_power'] > 0]
+        self.rows = claims.reset_index(drop=True)
+        codes, self.miner_ids = pd.factorize(self.rows['miner_id'])
+        self.code_of = {miner: code for code, miner in enumerate(self.miner_ids)}
+        self.timeline = _Timeline(codes, self.rows['height'].to_numpy(),
+                                  len(self.miner_ids))
+
+    def as_of(self, height: int):
+        '''
+        latest claim of every miner at `height`, as returned by
+        `datautils.get_active_power_actors`
+        '''
+        positions = self.timeline.latest(height)
+        rows = self.timeline.order[positions[positions >= 0]]
+        return self.rows.iloc[rows].reset_index(drop=True)
+
+    def power(self, miner_id: str, height: int):
+        '''
+        raw byte power of `miner_id` at `height`, 0 if it had none
+        '''
+        code = self.code_of.get(miner_id)
+        if code is None:
+            return 0
+        timeline = self.timeline
+        start, stop = timeline.starts[code], timeline.stops[code]
+        position = start + np.searchsorted(timeline.heights[start:stop], height,
+                                           side='right') - 1
+        if position < start:
+            return 0
+        return self.rows['raw_byte_power'].iat[timeline.order[position]]
+
+
+class DealHistory:
+    '''
+    deals active at any height, from the `market_deal_proposals` history
+    with their start and end epochs.
+
+    A deal is active at H if it was proposed (`height`) and started at or
+    before H, and ends at or after H, like in `datautils.get_market_deals`.
+    '''
+
+    SIDES = ['client_id', 'provider_id']
+
+    def __init__(self, deals: pd.core.frame.DataFrame,
+                 size_column: str = 'unpadded_piece_size'):
+        self.size_column = size_column
+        self.rows = deals.reset_index(drop=True)
+        self.active_from = np.maximum(self.rows['height'].to_numpy(dtype=np.int64),
+                                      self.rows['start_epoch'].to_numpy(dtype=np.int64))
+        self.active_to = self.rows['end_epoch'].to_numpy(dtype=np.int64)
+        sizes = self.rows[size_column].to_numpy(dtype=np.int64)
+        self.sides = {}
+        for side in self.SIDES:
+            codes, ids = pd.factorize(self.rows[side])
+            starts = _Timeline(codes, self.active_from, len(ids))
+            ends = _Timeline(codes, self.active_to, len(ids))
+            self.sides[side] = {
+                'ids': ids,
+                'code_of': {Id: code for code, Id in enumerate(ids)},
+                'started': starts,
+                'ended': ends,
+                # prefix sums of sizes in each timeline's order
+                'started_bytes': np.concatenate([[0], np.cumsum(sizes[starts.order])]),
+                'ended_bytes': np.concatenate([[0], np.cumsum(sizes[ends.order])]),
+            }
+
+    def totals_as_of(self, height: int, side: str):
+        '''
+        total deal bytes of every id on `side` at `height`, as a series
+        indexed by id with only the ids that have active deals
+        '''
+        index = self.sides[side]
+        started, ended = index['started'], index['ended']
+        # deals started by H, minus those that ended before H
+        n_started = started.count_upto(height)
+        n_ended = ended.count_upto(height - 1)
+        started_bytes = index['started_bytes'][n_started] - index['started_bytes'][started.starts]
+        ended_bytes = index['ended_bytes'][n_ended] - index['ended_bytes'][ended.starts]
+        active = (n_started - started.starts) - (n_ended - ended.starts)
+        totals = pd.Series(started_bytes - ended_bytes, index=index['ids'],
+                           name=self.size_column)
+        return totals[active > 0]
+
+    def aggregates_as_of(self, height: int):
+        '''
+        `indexes.DealAggregates` of the deals active at `height`
+        '''
+        return DealAggregates.from_totals(self.totals_as_of(height, 'client_id'),
+                                          self.totals_as_of(height, 'provider_id'))
+
+    def as_of(self, height: int):
+        '''
+        deals active at `height`
+        '''
+        active = (self.active_from <= height) & (self.active_to >= height)
+        return self.rows[active].reset_index(drop=True)
+
+    def active_deals(self, Id: str, height: int, side: str):
+        '''
+        deals of `Id` on `side` ('client_id' or 'provider_id') active at
+        `height`
+        '''
+        index = self.sides[side]
+        code = index['code_of'].get(Id)
+        if code is None:
+            return self.rows.iloc[:0]
+        started = index['started']
+        rows = started.order[started.starts[code]:started.stops[code]]
+        rows = rows[(self.active_from[rows] <= height) & (self.active_to[rows] >= height)]
+        return self.rows.iloc[np.sort(rows)]
+
+
+class TemporalStore:
+    '''
+    the datasets of `preprocess.dataPreprocess` at any height between the
+    ones the history was loaded for, see `preprocess.historyPreprocess`.
+
+    Addresses do not change over time, so the address index is built once
+    from the list at the largest height and shared by every height.
+    '''
+
+    def __init__(self, miner_infos: pd.core.frame.DataFrame,
+                 power_claims: pd.core.frame.DataFrame,
+                 deals: pd.core.frame.DataFrame,
+                 addresses: pd.core.frame.DataFrame, core: list = None):
+        self.miners = MinerHistory(miner_infos)
+        self.powers = PowerHistory(power_claims)
+        self.deals = DealHistory(deals)
+        self.addresses = addresses
+        self.address_index = AddressIndex(addresses)
+        self.core = core if core is not None else []
+
+    def datasets_as_of(self, height: int, latest_owner: bool = False):
+        '''
+        datasets and indexes at `height`, with the same keys as
+        `preprocess.dataPreprocess(height, ..., deal_totals='stream')`
+        and no votes
+
+        Parameters
+        ----------
+        height : int
+            snapshot height.
+        latest_owner : bool, optional
+            see `MinerHistory.as_of`.
+
+        '''
+        datasets = {'deals': None,
+                    'miners': self.miners.as_of(height, latest=latest_owner),
+                    'addresses': self.addresses,
+                    'votes': None,
+                    'core': self.core,
+                    'powers': self.powers.as_of(height),
+                    'address_index': self.address_index,
+                    'deal_aggregates': self.deals.aggregates_as_of(height)}
+        return build_indexes(datasets)
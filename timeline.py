@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tallies over the course of a poll.
+
+The votes are sorted once by creation time and weighed with
+`counting.weigh_votes`. Every group is then turned into a stream of events
+(a vote added, or a vote removed by an owner override, see
+`counting.membership_events`) with per-option prefix sums. The tally as of
+any time T is a binary search for T followed by a read of the sums, and a
+chart of a group over the poll window is one vectorized search.
+
+Votes created before the poll opens or after it closes are dropped, using
+the same sorted order.
+
+The votes API updates a vote in place on a revote, so the option of a
+revoted vote is its latest one at every time after its creation. With a
+multisig index in the datasets, the token group includes the multisig votes
+from the time their threshold is reached.
+
+@author: JP
+"""
+
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from bigint import exact_sum
+from counting import weigh_votes, membership_events, replay_token_votes
+from votes import expand_signatures, has_signature_columns
+
+GROUPS = ['deal', 'capacity', 'client', 'token', 'core']
+
+
+class Timeline:
+    '''
+    per-group tallies of a poll at any point in time.
+
+    * `times` creation time of every counted vote, sorted
+    * `votes` the counted votes, in that order
+    * `rejected` votes created outside the poll window
+    * `opens` / `closes` the poll window, or None if open-ended
+    '''
+
+    def __init__(self, list_of_votes: pd.core.frame.DataFrame, datasets: dict,
+                 opens=None, closes=None, time_column: str = 'createdAt'):
+        '''
+        Parameters
+        ----------
+        list_of_votes : pandas.DataFrame
+            votes, as returned by `votes.Votes`.
+        datasets : dict
+            as returned by `preprocess.dataPreprocess`.
+        opens, closes : datetime-like, optional
+            the poll window. Votes created before `opens` or after `closes`
+            are not counted.
+        time_column : str, optional
+            timestamp the votes are ordered by. The default is 'createdAt'.
+
+        '''
+        self.opens = None if opens is None else pd.Timestamp(opens)
+        self.closes = None if closes is None else pd.Timestamp(closes)
+        if not has_signature_columns(list_of_votes):
+            list_of_votes = expand_signatures(list_of_votes.copy())
+
+        order = np.argsort(list_of_votes[time_column].to_numpy(), kind='stable')
+        ordered = list_of_votes.iloc[order]
+        times = ordered[time_column].to_numpy()
+        lo = 0 if self.opens is None else np.searchsorted(
+            times, self.opens.to_datetime64(), side='left')
+        hi = len(times) if self.closes is None else np.searchsorted(
+            times, self.closes.to_datetime64(), side='right')
+        self.rejected = pd.concat([ordered.iloc[:lo], ordered.iloc[hi:]])
+        self.votes = ordered.iloc[lo:hi]
+        self.times = times[lo:hi]
+
+        weights = weigh_votes(self.votes, datasets)
+        events = _group_events(weights, datasets.get('multisig_index'))
+        self.streams = {gr: _stream(events) for gr, events in events.items()}
+
+    def _index(self, time):
+        '''
+        number of votes created at or before `time`
+        '''
+        if time is None:
+            return len(self.times)
+        return int(np.searchsorted(self.times, pd.Timestamp(time).to_datetime64(),
+                                   side='right'))
+
+    def tally(self, time=None, group: str = None):
+        '''
+        tally as of `time` (the end of the poll if None)
+
+        Returns
+        -------
+        tally : dict
+            option -> amount, for `group`, or group -> option -> amount if
+            `group` is None. Same as `groups.tally` after counting the votes
+            created up to `time`.
+
+        '''
+        if group is None:
+            return {gr: self.tally(time, gr) for gr in GROUPS}
+        stream = self.streams[group]
+        k = stream.searchsorted(self._index(time))
+        return {option: int(stream.amounts[option][k])
+                for option in stream.options if stream.counts[option][k] > 0}
+
+    def turnout(self, time=None, group: str = None):
+        '''
+        number of voters counted in `group` (or in each group, if None) as
+        of `time`
+        '''
+        if group is None:
+            return {gr: self.turnout(time, gr) for gr in GROUPS}
+        stream = self.streams[group]
+        k = stream.searchsorted(self._index(time))
+        return int(sum(stream.counts[option][k] for option in stream.options))
+
+    def series(self, group: str, times=None, shares: bool = False):
+        '''
+        tally of `group` at each of `times`, for charts
+
+        Parameters
+        ----------
+        group : str
+            'deal', 'capacity', 'client', 'token' or 'core'.
+        times : array-like, optional
+            times to evaluate at. Every vote creation time if None.
+        shares : bool, optional
+            if True, the share of each option instead of its amount.
+
+        Returns
+        -------
+        series : pandas.DataFrame
+            indexed by time, one column per option.
+
+        '''
+        stream = self.streams[group]
+        if times is None:
+            times = self.times
+        times = pd.DatetimeIndex(times)
+        n_votes = np.searchsorted(self.times, times.to_numpy(), side='right')
+        k = np.searchsorted(stream.positions, n_votes, side='left')
+        df = pd.DataFrame({option: stream.amounts[option][k]
+                           for option in stream.options}, index=times)
+        if shares:
+            total = df.sum(axis=1)
+            df = df.div(total.where(total != 0), axis=0).astype(float)
+        return df
+
+    def plot(self, group: str, times=None, shares: bool = True, ax=None):
+        '''
+        plots `series(group, times, shares)`
+        '''
+        if ax is None:
+            _, ax = plt.subplots()
+        df = self.series(group, times, shares=shares)
+        for option in df.columns:
+            ax.step(df.index, df[option].astype(float), where='post', label=option)
+        ax.set_title(group)
+        ax.set_ylabel('share of the vote' if shares else 'amount')
+        ax.legend()
+        return ax
+
+
+class _Stream:
+    '''
+    events of one group, with prefix sums per option. Entry k of the sums
+    is the state after the first k events
+    '''
+
+    def __init__(self, positions, options, amounts, counts):
+        self.positions = positions
+        self.options = options
+        self.amounts = amounts
+        self.counts = counts
+
+    def searchsorted(self, n_votes: int):
+        '''
+        number of events caused by the first `n_votes` votes
+        '''
+        return int(np.searchsorted(self.positions, n_votes, side='left'))
+
+
+def _group_events(weights, multisig_index=None):
+    '''
+    events of every group, as dataframes with columns 'position',
+    'optionName', 'quantity' and 'sign' (+1 added, -1 removed), in
+    processing order
+    '''
+    events = {}
+    eligible = {'core': weights['is_core'].to_numpy(dtype=bool),
+                'token': np.ones(len(weights), dtype=bool),
+                'client': np.array([total > 0 for total in weights['client']],
+                                   dtype=bool)}
+    quantity = {'core': lambda kept: [1] * len(kept),
+                'token': lambda kept: [int(balance) for balance in kept['balance']],
+                'client': lambda kept: kept['client'].tolist()}
+    for gr in ['core', 'token', 'client']:
+        # votes are never removed from these groups, so only the first
+        # eligible vote of every signer counts
+        kept = weights[eligible[gr]].drop_duplicates('signer', keep='first')
+        events[gr] = pd.DataFrame({'position': kept['position'].to_numpy(),
+                                   'optionName': kept['optionName'].to_numpy(),
+                                   'quantity': pd.Series(quantity[gr](kept), dtype=object).to_numpy(),
+                                   'sign': 1})
+    if multisig_index is not None:
+        events['token'] = _token_events(weights, multisig_index)
+
+    membership = membership_events(weights)
+    changes = membership[membership['added'] | membership['removed']]
+    positions = changes['position'].to_numpy()
+    for gr in ['capacity', 'deal']:
+        added = changes['added'].to_numpy()
+        option = np.where(added, weights['optionName'].to_numpy(dtype=object)[positions], None)
+        amount = np.where(added, weights[gr].to_numpy(dtype=object)[positions], None)
+        # a removal takes away the vote its signer added last
+        held = pd.DataFrame({'signer': changes['signer'].to_numpy(),
+                             'optionName': option, 'quantity': amount}, dtype=object)
+        held = held.groupby('signer', sort=False)[['optionName', 'quantity']].ffill()
+        events[gr] = pd.DataFrame({'position': positions,
+                                   'optionName': held['optionName'].to_numpy(),
+                                   'quantity': held['quantity'].to_numpy(),
+                                   'sign': np.where(added, 1, -1)})
+    return events
+
+
+def _token_events(weights, multisig_index):
+    '''
+    token events with the multisig votes, from the same replay as
+    `counting.count_all`. Votes are applied in position order, so a
+    multisig vote is only ever added, by the vote that completed its
+    threshold
+    '''
+    group = replay_token_votes(weights, multisig_index)
+    first = weights.drop_duplicates('signer', keep='first')
+    position_of = dict(zip(first['signer'], first['position']))
+    positions = [thisVote.other['position'] if isinstance(thisVote.other, dict)
+                 else position_of[thisVote.signer] for thisVote in group.listVotes]
+    return pd.DataFrame({'position': np.asarray(positions, dtype=np.int64),
+                         'optionName': [thisVote.vote for thisVote in group.listVotes],
+                         'quantity': pd.Series([int(thisVote.quantity) for thisVote
+                                                in group.listVotes], dtype=object).to_numpy(),
+                         'sign': 1})
+
+
+def _stream(events):
+    options = sorted(set(events['optionName']))
+    sign = events['sign'].tolist()
+    amounts = {}
+    counts = {}
+    for option in options:
+        is_option = (events['optionName'] == option).to_numpy()
+        amounts[option] = _prefix_sums(
+            [q * s if o else 0 for q, s, o in zip(events['quantity'], sign, is_option)])
+        counts[option] = np.concatenate([[0], np.cumsum(np.where(is_option, events['sign'], 0))])
+    return _Stream(events['position'].to_numpy(dtype=np.int64), options, amounts, counts)
+
+
+def _prefix_sums(values):
+    '''
+    prefix sums of integers, starting with 0. int64 when they cannot
+    overflow, python ints otherwise (e.g. balances in attoFIL)
+    '''
+    try:
+        array = np.asarray(values, dtype=np.int64)
+    except (OverflowError, TypeError, ValueError):
+        array = None
+    if array is not None and exact_sum(np.abs(array)) < 2**63:
+        return np.concatenate([[0], np.cumsum(array)])
+    return np.concatenate([np.array([0], dtype=object),
+                           np.cumsum(np.asarray(values, dtype=object))])
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Span-based timer for the preprocessing and counting pipeline.
+
+Tracing is off by default. While it is off, `span` returns a shared no-op
+context manager, so an instrumented block costs one function call. Once it
+is switched on with `enable`, every span records its wall time under its
+name and under its stack of enclosing spans, e.g.
+
+    import tracing
+    tracing.enable()
+    datasets,groups_of_voters=recount_all()
+    tracing.report()                       # per-span totals, p50 and p99
+    tracing.export_json('datasets/trace.json')
+    tracing.export_folded('datasets/trace.folded')
+
+The folded file has one line per stack with its self time in microseconds,
+which is the input format of flamegraph.pl and speedscope.
+
+@author: JP
+"""
+
+import functools
+import json
+import threading
+import time
+from array import array
+import numpy as np
+
+_enabled = False
+_lock = threading.Lock()
+_local = threading.local()
+# span name -> durations in seconds
+_durations = {}
+# stack of span names -> self time in seconds
+_self_times = {}
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+class _Span:
+    '''
+    a running span; its time is recorded when it exits
+    '''
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        stack = _stack()
+        stack.append(self)
+        self.children = 0.0
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.t0
+        stack = _stack()
+        path = tuple(span.name for span in stack)
+        stack.pop()
+        if stack:
+            stack[-1].children += elapsed
+        with _lock:
+            _durations.setdefault(self.name, array('d')).append(elapsed)
+            _self_times[path] = _self_times.get(path, 0.0) + elapsed - self.children
+        return False
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def enable():
+    '''
+    starts recording spans
+    '''
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    '''
+    stops recording spans. What was recorded is kept until `reset`
+    '''
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    '''
+    discards every recorded span
+    '''
+    with _lock:
+        _durations.clear()
+        _self_times.clear()
+
+
+def span(name: str):
+    '''
+    context manager that times the enclosed block as `name`, or does nothing
+    if tracing is off
+    '''
+    if not _enabled:
+        return _NOOP
+    return _Span(name)
+
+
+def traced(name: str = None):
+    '''
+    decorator that times every call of a function, as `name` or as
+    module.function by default
+    '''
+    def decorator(function):
+        label = name or '{}.{}'.format(function.__module__, function.__name__)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Span(label):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def propagate(function):
+    '''
+    wraps `function` so that, when it runs on another thread, its spans are
+    nested under the spans that are open here, e.g. for the fetches that
+    `preprocess.dataPreprocess` submits to a thread pool
+    '''
+    if not _enabled:
+        return function
+    parents = [span.name for span in _stack()]
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        stack = _stack()
+        outer = stack[:]
+        stack[:] = [_Span(name) for name in parents]
+        for parent in stack:
+            parent.children = 0.0
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stack[:] = outer
+    return wrapper
+
+
+def summary():
+    '''
+    aggregates the recorded spans
+
+    Returns
+    -------
+    summary : dict
+        span name -> 'count', 'total', 'mean', 'p50', 'p99' and 'max', in
+        seconds, sorted by total time.
+
+    '''
+    with _lock:
+        durations = {name: np.frombuffer(values, dtype=np.float64).copy()
+                     for name, values in _durations.items()}
+    result = {}
+    for name, values in durations.items():
+        result[name] = {'count': int(len(values)),
+                        'total': float(values.sum()),
+                        'mean': float(values.mean()),
+                        'p50': float(np.percentile(values, 50)),
+                        'p99': float(np.percentile(values, 99)),
+                        'max': float(values.max())}
+    return dict(sorted(result.items(), key=lambda kv: -kv[1]['total']))
+
+
+def report():
+    '''
+    prints the summary of the recorded spans and returns it
+    '''
+    result = summary()
+    print('{:>40} {:>9} {:>10} {:>10} {:>10}'.format(
+        'span', 'count', 'total s', 'p50 ms', 'p99 ms'))
+    for name, stats in result.items():
+        print('{:>40} {:>9} {:>10.3f} {:>10.3f} {:>10.3f}'.format(
+            name, stats['count'], stats['total'],
+            1000 * stats['p50'], 1000 * stats['p99']))
+    return result
+
+
+def export_json(path: str):
+    '''
+    writes the summary and the self time of every stack to `path` as JSON
+    '''
+    with _lock:
+        stacks = {';'.join(path): seconds for path, seconds in _self_times.items()}
+    with open(path, 'w') as f:
+        json.dump({'spans': summary(), 'stacks': stacks}, f, indent=2)
+
+
+def export_folded(path: str):
+    '''
+    writes the recorded stacks to `path` in the folded format used by
+    flame graph tools: one `outer;inner <microseconds>` line per stack
+    '''
+    with _lock:
+        stacks = dict(_self_times)
+    with open(path, 'w') as f:
+        for stack, seconds in sorted(stacks.items()):
+            f.write('{} {}\n'.format(';'.join(stack), max(int(seconds * 1e6), 0)))
@@ -7,40 +7,348 @@ This script pings the real-live voter data and retrieves votes
 @author: JP, juan.madrigalcianci@protocol.ai"""
 
 
+import asyncio
+import gzip
+import http.client
 import json
+import re
+import threading
 import pandas as pd
-from urllib.request import urlopen
-from datetime import datetime
+from urllib.parse import urljoin, urlsplit
 pd.options.mode.chained_assignment = None  # default='warn'
 
+POLL_URL='https://api.filpoll.io/api/polls/{}/view-votes'
+
+
+class VotesClient:
+    '''
+    asyncio client for the filpoll votes API.
+
+    The requests themselves are blocking `http.client` calls that run on the
+    default executor of the event loop (`asyncio.to_thread`), so polls are
+    fetched concurrently by threads, up to the size of that executor, and a
+    request never blocks the event loop.
+
+    * connections are kept alive and reused; up to `max_connections` idle
+      connections are kept per host
+    * responses are requested gzipped
+    * the ETag / Last-Modified of every URL is remembered, so fetching a
+      poll that has not changed costs a 304 and returns the cached votes
+    * paginated responses are followed, either through a `Link: <...>;
+      rel="next"` header or a JSON body of the form {"data": [...], "next": url}
+    * requests time out after `timeout` seconds and are retried up to
+      `retries` times with exponential backoff
+
+    `url` is a template with a `{}` for the poll id, so the client can be
+    pointed at a local server.
+    '''
+
+    def __init__(self,url:str=POLL_URL,timeout:float=30,retries:int=3,
+                 backoff:float=0.5,max_connections:int=4):
+        self.url=url
+        self.timeout=timeout
+        self.retries=retries
+        self.backoff=backoff
+        self.max_connections=max_connections
+        self.validators={}
+        self.cached={}
+        self._pools={}
+
+    async def fetch(self,pollId):
+        '''
+        fetches the votes of poll `pollId`
+
+        Returns
+        -------
+        votes : list
+            list of votes (dicts), as returned by the API.
+        changed : bool
+            False if the server answered that nothing changed since the
+            last fetch, in which case `votes` is the cached list.
+
+        '''
+        url=self.url.format(pollId)
+        votes=[]
+        changed=False
+        while url is not None:
+            page,url,page_changed=await self._get(url)
+            votes.extend(page)
+            changed=changed or page_changed
+        return votes,changed
+
+    async def fetch_many(self,pollIds:list):
+        '''
+        fetches several polls concurrently, on the threads of the default
+        executor. Returns a dict pollId -> (votes, changed)
+        '''
+        results=await asyncio.gather(*[self.fetch(pollId) for pollId in pollIds])
+        return dict(zip(pollIds,results))
+
+    def close(self):
+        for idle in self._pools.values():
+            for connection in idle:
+                connection.close()
+        self._pools={}
+
+    async def _get(self,url:str):
+        '''
+        gets one page. Returns its votes, the url of the next page (or None)
+        and whether it changed
+        '''
+        headers={'Accept':'application/json','Accept-Encoding':'gzip'}
+        validators=self.validators.get(url,{})
+        if 'etag' in validators:
+            headers['If-None-Match']=validators['etag']
+        if 'last-modified' in validators:
+            headers['If-Modified-Since']=validators['last-modified']
+
+        status,response_headers,body=await self._request(url,headers)
+        if status==304:
+            page,next_url=self.cached[url]
+            return page,next_url,False
+        if status!=200:
+            raise IOError('GET {} returned {}'.format(url,status))
+
+        if response_headers.get('content-encoding','')=='gzip':
+            body=gzip.decompress(body)
+        data=json.loads(body)
+        next_url=_next_from_link(response_headers.get('link'))
+        if isinstance(data,dict):
+            next_url=data.get('next') or next_url
+            data=data.get('data',[])
+        if next_url is not None:
+            next_url=urljoin(url,next_url)
+
+        self.validators[url]={key:response_headers[key]
+                              for key in ('etag','last-modified')
+                              if key in response_headers}
+        self.cached[url]=(data,next_url)
+        return data,next_url,True
+
+    async def _request(self,url:str,headers:dict):
+        '''
+        sends a GET on a kept-alive connection, retrying on network errors,
+        timeouts and 5xx responses
+        '''
+        parts=urlsplit(url)
+        path=parts.path+('?'+parts.query if parts.query else '')
+        for attempt in range(self.retries+1):
+            connection=self._acquire(parts.scheme,parts.netloc)
+            try:
+                status,response_headers,body=await asyncio.to_thread(
+                    _send,connection,path,headers)
+            except (OSError,http.client.HTTPException) as error:
+                # the server may have closed the kept-alive connection
+                connection.close()
+                if attempt==self.retries:
+                    raise error
+            else:
+                self._release(parts.scheme,parts.netloc,connection)
+                if status<500 or attempt==self.retries:
+                    return status,response_headers,body
+            await asyncio.sleep(self.backoff*2**attempt)
+
+    def _acquire(self,scheme:str,netloc:str):
+        idle=self._pools.setdefault((scheme,netloc),[])
+        if idle:
+            return idle.pop()
+        connection_class=(http.client.HTTPSConnection if scheme=='https'
+                          else http.client.HTTPConnection)
+        return connection_class(netloc,timeout=self.timeout)
+
+    def _release(self,scheme:str,netloc:str,connection):
+        idle=self._pools.setdefault((scheme,netloc),[])
+        if len(idle)<self.max_connections:
+            idle.append(connection)
+        else:
+            connection.close()
+
+
+def _send(connection,path:str,headers:dict):
+    connection.request('GET',path,headers=headers)
+    response=connection.getresponse()
+    body=response.read()
+    response_headers={key.lower():value for key,value in response.getheaders()}
+    return response.status,response_headers,body
+
+
+def _next_from_link(link:str):
+    if not link:
+        return None
+    match=re.search(r'<([^>]*)>\s*;\s*rel="?next"?',link)
+    return match.group(1) if match else None
+
+
+# columns of a vote returned by the API
+VOTE_COLUMNS=['id','pollId','constituentGroupId','optionId','address',
+              'signerAddress','signature','power','balance','lockedBalance',
+              'uploaded','createdAt','updatedAt']
+
+# columns added by `expand_signatures`, from the fields of the signature JSON
+SIGNATURE_COLUMNS={'signer':'signer',
+                   'optionName':'optionName',
+                   'power':'signaturePower',
+                   'balance':'signatureBalance',
+                   'message':'message'}
+
+
+def ingest(df:pd.core.frame.DataFrame):
+    '''
+    puts the votes in the right format, as the API returns all strings. Every
+    conversion is done column by column, and the signature JSON is parsed
+    once here so that counting never has to
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        votes as returned by the API.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        same votes, with integer 'power', 'balance' and 'lockedBalance',
+        datetime 'createdAt' and 'updatedAt', and the signature columns
+        added by `expand_signatures`. A poll with no votes gives an empty
+        dataframe with the same columns.
+
+    '''
+    if len(df.columns)==0:
+        # the API returned [], so there are no columns to convert
+        df=pd.DataFrame(columns=VOTE_COLUMNS,dtype=object)
+    df=df.copy()
+    for column in ['power','balance','lockedBalance']:
+        if column in df:
+            df[column]=to_int(df[column])
+    for column in ['createdAt','updatedAt']:
+        if column in df:
+            df[column]=pd.to_datetime(df[column],format='%Y-%m-%dT%H:%M:%S.%fZ')
+    return expand_signatures(df)
+
+
+def expand_signatures(df:pd.core.frame.DataFrame):
+    '''
+    parses the 'signature' JSON of every vote once and adds its fields as the
+    columns in SIGNATURE_COLUMNS, with the power and balance as integers
+    '''
+    signatures=pd.DataFrame.from_records(
+        [json.loads(signature) for signature in df['signature']],
+        columns=list(SIGNATURE_COLUMNS),index=df.index)
+    for field,column in SIGNATURE_COLUMNS.items():
+        df[column]=signatures[field].astype(object)
+    df['signaturePower']=to_int(df['signaturePower'])
+    df['signatureBalance']=to_int(df['signatureBalance'])
+    return df
+
+
+def has_signature_columns(df:pd.core.frame.DataFrame):
+    return all(column in df for column in SIGNATURE_COLUMNS.values())
+
+
+def to_int(column:pd.core.series.Series):
+    '''
+    converts a column of numeric strings to int64, or to python ints if
+    some values do not fit in an int64 (e.g. balances in attoFIL)
+    '''
+    try:
+        return column.astype('int64')
+    except (ValueError,TypeError,OverflowError):
+        return pd.Series([None if pd.isna(x) else int(x) for x in column],
+                         index=column.index,dtype=object)
+
+
+def _run(coroutine):
+    '''
+    runs `coroutine` to completion from synchronous code. Inside a running
+    event loop (e.g. a notebook), where `asyncio.run` cannot be nested, it
+    runs on a new event loop in a separate thread and the caller waits for it
+    '''
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    result={}
+    def target():
+        try:
+            result['value']=asyncio.run(coroutine)
+        except BaseException as error:
+            result['error']=error
+    thread=threading.Thread(target=target)
+    thread.start()
+    thread.join()
+    if 'error' in result:
+        raise result['error']
+    return result['value']
+
+
+async def getPollsAsync(pollIds:list,client:VotesClient=None):
+    '''
+    same as `getPolls`, to be awaited from a running event loop
+    '''
+    client=client if client is not None else VotesClient()
+    fetched=await client.fetch_many(list(pollIds))
+    polls={}
+    for pollId,(data_json,_) in fetched.items():
+        polls[pollId]=ingest(pd.DataFrame(data_json)) if len(data_json) else None
+    return polls
+
+
+def getPolls(pollIds:list,client:VotesClient=None):
+    '''
+    fetches the votes of several polls concurrently. From async code, await
+    `getPollsAsync` instead
+
+    Parameters
+    ----------
+    pollIds : list
+        ids of the polls.
+    client : VotesClient, optional
+        client to fetch with. A new one if None.
+
+    Returns
+    -------
+    polls : dict
+        pollId -> votes as a typed dataframe (see `ingest`), or None if the
+        poll has no votes.
+
+    '''
+    return _run(getPollsAsync(pollIds,client))
+
+
 class Votes:
     '''
-    class to ping the votes
+    class to ping the votes of poll `pollId`
     '''
     
-    def __init__(self):
-        self.URL='https://api.filpoll.io/api/polls/16/view-votes'
-        self.response=urlopen(self.URL)
+    def __init__(self,pollId=16,client:VotesClient=None):
+        self.pollId=pollId
+        self.client=client if client is not None else VotesClient()
+        self.URL=self.client.url.format(pollId)
+        self.votes=None
         
     def getVotes(self):
         '''
         Retrieves an updated list of votes as a pandas dataframe on
-        self.votes
+        self.votes. If the poll has not changed since the last call,
+        self.votes is left as it is. From async code, await `getVotesAsync`
+        instead
         '''
-        
-        data_json = json.loads(self.response.read())
-        df=pd.DataFrame(data_json)
-        N_votes=len(df)
-        for n in range(N_votes):
-            # # puts votes in the right format, as database returns all strings
-            df['power'].iloc[n]=int(df['power'].iloc[n])
-            df['balance'].iloc[n]=int(df['balance'].iloc[n])
-            df['lockedBalance'].iloc[n]=int(df['lockedBalance'].iloc[n])
-        df['createdAt']=df['createdAt'].apply(lambda x:datetime.strptime(x, '%Y-%m-%dT%H:%M:%S.%fZ'))
-        df['updatedAt']=df['updatedAt'].apply(lambda x:datetime.strptime(x, '%Y-%m-%dT%H:%M:%S.%fZ'))
-                
-        
-        self.votes=df
+        _run(self.getVotesAsync())
+
+    async def getVotesAsync(self):
+        '''
+        same as `getVotes`, to be awaited from a running event loop
+        '''
+        data_json,changed=await self.client.fetch(self.pollId)
+        if not changed and self.votes is not None:
+            return
+        self.votes=self.toDataFrame(data_json)
+    
+    def toDataFrame(self,data_json:list):
+        '''
+        converts the votes returned by the API to a typed dataframe, see
+        `ingest`
+        '''
+        return ingest(pd.DataFrame(data_json))
     
     def update(self):
         '''